@@ -0,0 +1,121 @@
+"""Throughput benchmark of the exposition parser against the pre-tokenizer parse.
+
+Usage: python benchmark/bench_parse.py [--size MB] [--rounds N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCHMARK, "sdk"))
+sys.path.insert(0, os.path.join(BENCHMARK, "..", "src"))
+
+import payloads
+from remote_python_kubernetes import parse_exposition
+
+
+def legacy_log(msg, type):
+    return
+
+
+def legacy_parse_key(line):
+    legacy_log("[remotekubernetesplugin.parse_key]", "info")
+
+    return str(line.split(' ')[0].split('{')[0])
+
+
+def legacy_parse_value(line):
+    legacy_log("[remotekubernetesplugin.parse_value]", "info")
+
+    return str(line.split(' ')[1])
+
+
+def legacy_parse_dimensions(line):
+    legacy_log("[remotekubernetesplugin.parse_dimensions]", "info")
+
+    dimensions = []
+
+    if len(line.split(' ')[0].split('{')) >= 2:
+        dims_temp = str(str(line.split(' ')[0].split('{')[1])).replace('{', '').replace('}', '').replace('"', '').split(',')
+
+        for dim_temp in dims_temp:
+            if len(dim_temp.split('=')) >= 2:
+                dimensions.append({'key': dim_temp.split('=')[0], 'value': dim_temp.split('=')[1]})
+
+    return dimensions
+
+
+def legacy_parse(lines):
+    """The parse/parse_key/parse_dimensions/parse_value chain as of plugin version 1.7."""
+    legacy_log("[remotekubernetesplugin.parse]", "info")
+
+    metrics = []
+
+    for line in lines:
+        if line.startswith("#") or line == '':
+            continue
+
+        metrics.append({'key': legacy_parse_key(line),
+                        'dimensions': legacy_parse_dimensions(line),
+                        'value': legacy_parse_value(line)})
+
+    return metrics
+
+
+KEYS = frozenset(["node_memory_MemTotal", "node_memory_MemFree", "node_memory_MemAvailable",
+                  "node_load1", "node_load5", "node_load15",
+                  "kube_deployment_status_replicas", "kube_deployment_status_replicas_available",
+                  "kube_deployment_status_replicas_unavailable", "kube_deployment_status_replicas_updated",
+                  "kube_pod_container_status_waiting", "kube_pod_container_status_running",
+                  "kube_pod_container_status_terminated", "kube_pod_container_status_ready",
+                  "kube_pod_container_resource_requests_memory_bytes"])
+
+
+def tokenizer_parse(lines):
+    return list(parse_exposition(lines, {}))
+
+
+def filtered_parse(lines):
+    return list(parse_exposition(lines, {}, KEYS))
+
+
+def measure(func, content, rounds):
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        samples = len(func(content.split('\n')))
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return samples, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=8, help="payload size in MB")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds per measurement, the best is reported")
+    args = parser.parse_args()
+
+    size = int(args.size * 1024 * 1024)
+    contents = {'kube-state-metrics': payloads.repeat(payloads.kube_state_metrics(), size),
+                'node-exporter': payloads.repeat(payloads.node_exporter(), size)}
+
+    print("%-20s %-10s %10s %10s %12s %10s" % ("payload", "parser", "MB", "kept", "kept/s", "MB/s"))
+
+    for name in contents:
+        content = contents[name]
+        megabytes = len(content) / 1024.0 / 1024.0
+
+        for label, func in (("legacy", legacy_parse), ("tokenizer", tokenizer_parse), ("filtered", filtered_parse)):
+            samples, elapsed = measure(func, content, args.rounds)
+            print("%-20s %-10s %10.1f %10d %12.0f %10.1f" % (name, label, megabytes, samples, samples / elapsed, megabytes / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""End-to-end benchmark of RemoteKubernetesPlugin.query against the fake API server.
+
+The fake API server runs in a child process, so the peak RSS measured here is
+the one of the plugin alone. The plugin reports into a stub topology builder
+and imports the stub SDK of benchmark/sdk instead of the ActiveGate one.
+
+Every run is appended to the history file; with --check the run is compared
+against the last run of the same scale and configuration and the script
+exits with 1 if it got slower or bigger by more than the given percentage.
+
+Usage: python benchmark/bench_query.py [--nodes N] [--pods N] [--polls N] [--latency MS]
+                                       [--failure-rate F] [--config JSON] [--history FILE] [--check PERCENT]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCHMARK, "sdk"))
+sys.path.insert(0, os.path.join(BENCHMARK, "..", "src"))
+
+from remote_python_kubernetes import RemoteKubernetesPlugin
+
+
+class Element(object):
+    def __init__(self, counters):
+        self.counters = counters
+
+    def report_property(self, key, value):
+        self.counters['properties'] += 1
+
+    def absolute(self, key, value, dimensions=None):
+        self.counters['samples'] += 1
+
+    def relative(self, key, value, dimensions=None):
+        self.counters['samples'] += 1
+
+    def per_second(self, key, value, dimensions=None):
+        self.counters['samples'] += 1
+
+
+class Group(Element):
+    def create_element(self, id, name):
+        self.counters['elements'] += 1
+
+        return Element(self.counters)
+
+
+class TopologyBuilder(object):
+    """Counts what the plugin reports instead of sending it anywhere."""
+
+    def __init__(self):
+        self.counters = {'groups': 0, 'elements': 0, 'properties': 0, 'samples': 0}
+
+    def create_group(self, id, name):
+        self.counters['groups'] += 1
+
+        return Group(self.counters)
+
+    def reset(self):
+        for counter in self.counters:
+            self.counters[counter] = 0
+
+
+def start_server(args):
+    command = [sys.executable, os.path.join(BENCHMARK, "fake_apiserver.py"),
+               "--nodes", str(args.nodes), "--pods", str(args.pods), "--annotated", str(args.annotated),
+               "--latency", str(args.latency), "--failure-rate", str(args.failure_rate)]
+    if args.ksm_pods is not None:
+        command.extend(["--ksm-pods", str(args.ksm_pods)])
+
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=BENCHMARK)
+    port = int(server.stdout.readline())
+
+    return server, port
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peak / 1024.0 / 1024.0
+
+    return peak / 1024.0
+
+
+def percentile(values, percent):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args, port):
+    config = {'id': "benchmark", 'url': "http://127.0.0.1:%d" % port, 'token': "benchmark", 'debug': "false"}
+    config.update(json.loads(args.config))
+
+    with open(os.path.join(BENCHMARK, "..", "src", "plugin.json")) as json_config:
+        json_config = json.load(json_config)
+
+    builder = TopologyBuilder()
+    plugin = RemoteKubernetesPlugin(topology_builder=builder)
+    plugin.initialize(config=config, json_config=json_config)
+
+    polls = []
+    try:
+        for poll in range(args.polls):
+            builder.reset()
+
+            start = time.perf_counter()
+            plugin.query()
+            elapsed = time.perf_counter() - start
+
+            polls.append({'seconds': elapsed, 'elements': builder.counters['elements'], 'samples': builder.counters['samples']})
+            print("poll %d: %.3f s, %d elements, %d samples" % (poll, elapsed, builder.counters['elements'], builder.counters['samples']))
+    finally:
+        plugin.close()
+
+    return polls
+
+
+def summarize(args, polls):
+    seconds = [poll['seconds'] for poll in polls]
+    samples = sum(poll['samples'] for poll in polls)
+    # Pods listed from the fake cluster: kube-state-metrics, one
+    # node-exporter per node and the application pods, but not the nodes
+    pods = 1 + args.nodes + args.pods
+
+    return {'time': time.time(), 'commit': git_commit(), 'python': sys.version.split()[0],
+            'scale': {'nodes': args.nodes, 'pods': args.pods, 'annotated': args.annotated, 'ksm_pods': args.ksm_pods,
+                      'latency': args.latency, 'failure_rate': args.failure_rate},
+            'config': json.loads(args.config), 'polls': len(polls),
+            'poll_seconds': {'min': min(seconds), 'p50': percentile(seconds, 50), 'max': max(seconds)},
+            'samples_per_poll': samples / float(len(polls)),
+            'samples_per_second': samples / sum(seconds),
+            'pods_per_second': pods * len(polls) / sum(seconds),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def previous_result(history, result):
+    if not os.path.exists(history):
+        return None
+
+    previous = None
+    with open(history) as lines:
+        for line in lines:
+            entry = json.loads(line)
+            if entry['scale'] == result['scale'] and entry['config'] == result['config'] and entry['polls'] == result['polls']:
+                previous = entry
+
+    return previous
+
+
+def check(previous, result, percent):
+    regressions = []
+    limit = 1 + percent / 100.0
+
+    if result['poll_seconds']['p50'] > previous['poll_seconds']['p50'] * limit:
+        regressions.append("p50 poll time %.3f s, was %.3f s" % (result['poll_seconds']['p50'], previous['poll_seconds']['p50']))
+    if result['peak_rss_mb'] > previous['peak_rss_mb'] * limit:
+        regressions.append("peak RSS %.1f MB, was %.1f MB" % (result['peak_rss_mb'], previous['peak_rss_mb']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=10, help="10 up to 5000")
+    parser.add_argument("--pods", type=int, default=100, help="application pods, up to 100000")
+    parser.add_argument("--annotated", type=float, default=0.0, help="share of application pods annotated for scraping")
+    parser.add_argument("--ksm-pods", type=int, default=None, help="pods described by kube-state-metrics")
+    parser.add_argument("--polls", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds added to every API server response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of API server requests failing with 500")
+    parser.add_argument("--config", default="{}", help="plugin properties as JSON, e.g. '{\"watch\": \"true\"}'")
+    parser.add_argument("--history", default=os.path.join(BENCHMARK, "results.jsonl"), help="JSON lines file the result is appended to")
+    parser.add_argument("--check", type=float, default=None, help="fail on a regression of more than PERCENT against the history")
+    args = parser.parse_args()
+
+    server, port = start_server(args)
+    try:
+        polls = run(args, port)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = summarize(args, polls)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    previous = previous_result(args.history, result)
+
+    with open(args.history, "a") as history:
+        history.write(json.dumps(result, sort_keys=True) + "\n")
+
+    if args.check is not None and previous is not None:
+        regressions = check(previous, result, args.check)
+        if regressions:
+            print("REGRESSION against %s: %s" % (previous.get('commit'), "; ".join(regressions)))
+            sys.exit(1)
+
+        print("no regression against %s" % previous.get('commit'))
+
+
+if __name__ == "__main__":
+    main()
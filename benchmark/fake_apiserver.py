@@ -0,0 +1,288 @@
+"""Fake Kubernetes API server serving a synthetic cluster for the benchmarks.
+
+Serves paginated /api/v1/nodes, /api/v1/pods, /api/v1/services and
+/api/v1/endpoints lists, also
+per namespace, filtered by spec.nodeName and metadata.namespace field selectors
+and "label in (...)" or "label=value" label selectors, the single objects
+behind them, empty service endpoints and the /proxy/metrics
+payloads of the pods: one kube-state-metrics pod, one node-exporter pod per
+node and, optionally, a share of application pods annotated for scraping.
+
+Usage: python benchmark/fake_apiserver.py [--port P] [--nodes N] [--pods N] [--services N]
+                                          [--annotated F] [--latency MS] [--failure-rate F]
+
+The port actually bound is printed as the first line on stdout.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import payloads
+
+NAMESPACES = 20
+
+POD_PATH = re.compile(r'^/api/v1/namespaces/([^/]+)/pods/([^/:]+)(?::[^/]+)?(/proxy(/.*))?$')
+SERVICE_PATH = re.compile(r'^/api/v1/namespaces/([^/]+)/(services|endpoints)/([^/]+)$')
+NODE_PATH = re.compile(r'^/api/v1/nodes/([^/]+)$')
+LIST_PATH = re.compile(r'^/api/v1/namespaces/([^/]+)/(pods|services|endpoints)$')
+FIELDS = {'spec.nodeName': lambda item: item['spec'].get('nodeName'),
+          'metadata.namespace': lambda item: item['metadata'].get('namespace')}
+
+
+class Cluster(object):
+    """Synthetic cluster, every object is generated from its index on demand."""
+
+    def __init__(self, nodes=10, pods=100, services=None, annotated=0.0, ksm_pods=None):
+        self.nodes = nodes
+        self.pods = pods
+        self.services = services if services is not None else max(1, pods // 10)
+        self.annotated = annotated
+        self.ksm_pods = ksm_pods if ksm_pods is not None else min(pods, 10000)
+
+        self.payloads = {}
+        self.payloads_lock = threading.Lock()
+
+    def node(self, index):
+        return {'metadata': {'name': "node-%d" % index, 'uid': "node-uid-%d" % index,
+                             'selfLink': "/api/v1/nodes/node-%d" % index, 'resourceVersion': "1",
+                             'creationTimestamp': "2024-01-01T00:00:00Z",
+                             'labels': {'kubernetes.io/role': "node", 'kubernetes.io/hostname': "node-%d" % index,
+                                        'beta.kubernetes.io/instance-type': "m5.xlarge"}},
+                'status': {'addresses': [{'type': "InternalIP", 'address': "10.%d.%d.%d" % (index >> 16 & 255, index >> 8 & 255, index & 255)},
+                                         {'type': "Hostname", 'address': "node-%d" % index}],
+                           'nodeInfo': {'machineID': "%032x" % index, 'systemUUID': "%032x" % index, 'bootID': "%032x" % index,
+                                        'kernelVersion': "5.15.0", 'osImage': "Ubuntu 22.04", 'containerRuntimeVersion': "containerd://1.7.0",
+                                        'kubeletVersion': "v1.29.0", 'kubeProxyVersion': "v1.29.0",
+                                        'operatingSystem': "linux", 'architecture': "amd64"}}}
+
+    def pod_count(self):
+        # kube-state-metrics, one node-exporter per node, then the application pods
+        return 1 + self.nodes + self.pods
+
+    def pod(self, index):
+        if index == 0:
+            namespace, name, node, labels, annotations = "kube-system", "kube-state-metrics", 0, {'app': "kube-state-metrics"}, {}
+        elif index <= self.nodes:
+            node = index - 1
+            namespace, name, labels, annotations = "kube-system", "node-exporter-%d" % node, {'app': "node-exporter"}, {}
+        else:
+            pod = index - 1 - self.nodes
+            namespace, name, node, labels = "ns-%d" % (pod % NAMESPACES), "pod-%d" % pod, pod % self.nodes, {'app': "app-%d" % (pod % 30)}
+            annotations = {}
+            if random.Random(pod).random() < self.annotated:
+                annotations = {'prometheus.io/scrape': "true", 'prometheus.io/port': "8080"}
+
+        return {'metadata': {'name': name, 'namespace': namespace, 'uid': "pod-uid-%d" % index,
+                             'selfLink': "/api/v1/namespaces/%s/pods/%s" % (namespace, name), 'resourceVersion': "1",
+                             'labels': labels, 'annotations': annotations},
+                'spec': {'nodeName': "node-%d" % node, 'containers': [{'name': "container-0"}, {'name': "container-1"}]},
+                'status': {'phase': "Running", 'podIP': "10.244.%d.%d" % (index >> 8 & 255, index & 255)}}
+
+    def service(self, index):
+        namespace = "ns-%d" % (index % NAMESPACES)
+
+        return {'metadata': {'name': "service-%d" % index, 'namespace': namespace, 'uid': "service-uid-%d" % index,
+                             'selfLink': "/api/v1/namespaces/%s/services/service-%d" % (namespace, index),
+                             'resourceVersion': "1", 'annotations': {}},
+                'spec': {'selector': {'app': "app-%d" % (index % 30)}, 'ports': [{'port': 80}]}}
+
+    def endpoints(self, index):
+        service = self.service(index)
+
+        return {'metadata': {'name': service['metadata']['name'], 'namespace': service['metadata']['namespace'],
+                             'uid': "endpoints-uid-%d" % index, 'resourceVersion': "1"},
+                'subsets': []}
+
+    def metrics(self, name):
+        if name == "kube-state-metrics":
+            kind = "kube-state-metrics"
+        elif name.startswith("node-exporter-"):
+            kind = "node-exporter"
+        else:
+            kind = "application"
+
+        with self.payloads_lock:
+            if kind not in self.payloads:
+                if kind == "kube-state-metrics":
+                    self.payloads[kind] = payloads.kube_state_metrics(pods=self.ksm_pods, deployments=max(1, self.ksm_pods // 10))
+                elif kind == "node-exporter":
+                    self.payloads[kind] = payloads.node_exporter(cpus=16, devices=4)
+                else:
+                    self.payloads[kind] = payloads.node_exporter(cpus=1, devices=1)
+                self.payloads[kind] = self.payloads[kind].encode("utf-8")
+
+            return self.payloads[kind]
+
+    def index(self, name, prefix):
+        if not name.startswith(prefix):
+            return None
+        try:
+            return int(name[len(prefix):])
+        except ValueError:
+            return None
+
+
+def selected(item, query):
+    for selector in query.get('fieldSelector', []):
+        for term in selector.split(","):
+            field, value = term.split("=", 1)
+            if field.endswith("!"):
+                if FIELDS[field[:-1]](item) == value:
+                    return False
+            elif FIELDS[field](item) != value:
+                return False
+
+    labels = item['metadata'].get('labels') or {}
+    for selector in query.get('labelSelector', []):
+        match = re.match(r'^\s*([^ =!]+)\s+in\s+\(([^)]*)\)\s*$', selector)
+        if match:
+            if labels.get(match.group(1)) not in [value.strip() for value in match.group(2).split(",")]:
+                return False
+        else:
+            label, value = selector.split("=", 1)
+            if labels.get(label.strip()) != value.strip():
+                return False
+
+    return True
+
+
+def page(items, count, query):
+    limit = int(query.get('limit', ["0"])[0])
+    start = int(query.get('continue', ["0"])[0] or 0)
+
+    indexes = range(count)
+    if 'fieldSelector' in query or 'labelSelector' in query:
+        indexes = [index for index in indexes if selected(items(index), query)]
+
+    end = min(len(indexes), start + limit) if limit else len(indexes)
+
+    return json.dumps({'kind': "List", 'apiVersion': "v1",
+                       'metadata': {'resourceVersion': "1", 'continue': str(end) if end < len(indexes) else ""},
+                       'items': [items(index) for index in indexes[start:end]]}).encode("utf-8")
+
+
+def create_handler(cluster, latency, failure_rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            return
+
+        def respond(self, status, body=b"", content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+
+            if failure_rate and random.random() < failure_rate:
+                return self.respond(500, b'{"kind": "Status", "code": 500}')
+
+            url = urlparse(self.path)
+            path = url.path
+            query = parse_qs(url.query)
+
+            if path == "/api/v1/nodes":
+                return self.respond(200, page(cluster.node, cluster.nodes, query))
+            if path == "/api/v1/pods":
+                return self.respond(200, page(cluster.pod, cluster.pod_count(), query))
+            if path == "/api/v1/services":
+                return self.respond(200, page(cluster.service, cluster.services, query))
+            if path == "/api/v1/endpoints":
+                return self.respond(200, page(cluster.endpoints, cluster.services, query))
+
+            match = LIST_PATH.match(path)
+            if match:
+                query.setdefault('fieldSelector', []).append("metadata.namespace=" + match.group(1))
+                if match.group(2) == "pods":
+                    return self.respond(200, page(cluster.pod, cluster.pod_count(), query))
+                if match.group(2) == "endpoints":
+                    return self.respond(200, page(cluster.endpoints, cluster.services, query))
+                return self.respond(200, page(cluster.service, cluster.services, query))
+
+            match = NODE_PATH.match(path)
+            if match:
+                index = cluster.index(match.group(1), "node-")
+                if index is not None and index < cluster.nodes:
+                    return self.respond(200, json.dumps(cluster.node(index)).encode("utf-8"))
+
+            match = POD_PATH.match(path)
+            if match:
+                namespace, name, proxy = match.group(1), match.group(2), match.group(3)
+                if proxy:
+                    return self.respond(200, cluster.metrics(name), "text/plain; version=0.0.4")
+
+                if name == "kube-state-metrics":
+                    index = 0
+                elif name.startswith("node-exporter-"):
+                    index = cluster.index(name, "node-exporter-")
+                    index = index + 1 if index is not None else None
+                else:
+                    index = cluster.index(name, "pod-")
+                    index = index + 1 + cluster.nodes if index is not None else None
+                if index is not None and index < cluster.pod_count():
+                    return self.respond(200, json.dumps(cluster.pod(index)).encode("utf-8"))
+
+            match = SERVICE_PATH.match(path)
+            if match:
+                index = cluster.index(match.group(3), "service-")
+                if index is not None and index < cluster.services:
+                    if match.group(2) == "endpoints":
+                        return self.respond(200, json.dumps({'kind': "Endpoints", 'subsets': []}).encode("utf-8"))
+                    return self.respond(200, json.dumps(cluster.service(index)).encode("utf-8"))
+
+            return self.respond(404, b'{"kind": "Status", "code": 404}')
+
+    return Handler
+
+
+def serve(port=0, nodes=10, pods=100, services=None, annotated=0.0, ksm_pods=None, latency=0.0, failure_rate=0.0):
+    """Starts the server on a daemon thread and returns it, latency in seconds."""
+    cluster = Cluster(nodes, pods, services, annotated, ksm_pods)
+    server = ThreadingHTTPServer(("127.0.0.1", port), create_handler(cluster, latency, failure_rate))
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name="fake-apiserver", daemon=True)
+    thread.start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=0, help="port to listen on, 0 picks a free one")
+    parser.add_argument("--nodes", type=int, default=10)
+    parser.add_argument("--pods", type=int, default=100, help="application pods, next to the exporters")
+    parser.add_argument("--services", type=int, default=None, help="defaults to one per 10 pods")
+    parser.add_argument("--annotated", type=float, default=0.0, help="share of application pods annotated for scraping")
+    parser.add_argument("--ksm-pods", type=int, default=None, help="pods described by kube-state-metrics, defaults to --pods up to 10000")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds added to every response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of requests answered with 500")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.nodes, args.pods, args.services, args.annotated, args.ksm_pods,
+                   args.latency / 1000.0, args.failure_rate)
+
+    print(server.server_address[1])
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
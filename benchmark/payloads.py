@@ -0,0 +1,83 @@
+"""Synthetic Prometheus exposition payloads for the benchmarks."""
+
+import random
+
+
+def kube_state_metrics(pods=2000, deployments=200, containers=2, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+
+    lines.append("# HELP kube_pod_container_status_ready Describes whether the containers readiness check succeeded.")
+    lines.append("# TYPE kube_pod_container_status_ready gauge")
+    for family in ("ready", "running", "waiting", "terminated", "restarts_total"):
+        lines.append("# HELP kube_pod_container_status_" + family + " Container status.")
+        lines.append("# TYPE kube_pod_container_status_" + family + " gauge")
+        for pod in range(pods):
+            for container in range(containers):
+                lines.append('kube_pod_container_status_%s{namespace="ns-%d",pod="pod-%d",container="container-%d",uid="%08x-0000-0000-0000-%012x"} %d'
+                             % (family, pod % 20, pod, container, pod, container, rnd.randint(0, 1)))
+
+    lines.append("# HELP kube_pod_container_resource_requests_memory_bytes Memory requested.")
+    lines.append("# TYPE kube_pod_container_resource_requests_memory_bytes gauge")
+    for pod in range(pods):
+        for container in range(containers):
+            lines.append('kube_pod_container_resource_requests_memory_bytes{namespace="ns-%d",pod="pod-%d",container="container-%d",node="node-%d"} %d'
+                         % (pod % 20, pod, container, pod % 50, rnd.randint(1, 1 << 30)))
+
+    for family in ("", "_available", "_unavailable", "_updated"):
+        lines.append("# HELP kube_deployment_status_replicas" + family + " Deployment replicas.")
+        lines.append("# TYPE kube_deployment_status_replicas" + family + " gauge")
+        for deployment in range(deployments):
+            lines.append('kube_deployment_status_replicas%s{namespace="ns-%d",deployment="deployment-%d"} %d'
+                         % (family, deployment % 20, deployment, rnd.randint(0, 3)))
+
+    for family in ("labels", "info", "created", "owner", "status_phase", "start_time"):
+        lines.append("# HELP kube_pod_" + family + " Pod information.")
+        lines.append("# TYPE kube_pod_" + family + " gauge")
+        for pod in range(pods):
+            lines.append('kube_pod_%s{namespace="ns-%d",pod="pod-%d",label_app="app-%d",label_version="v\\"%d\\""} 1'
+                         % (family, pod % 20, pod, pod % 30, pod % 3))
+
+    return "\n".join(lines) + "\n"
+
+
+def node_exporter(cpus=64, devices=16, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+
+    for name in ("node_load1", "node_load5", "node_load15"):
+        lines.append("# HELP " + name + " Load average.")
+        lines.append("# TYPE " + name + " gauge")
+        lines.append("%s %f" % (name, rnd.random() * 4))
+
+    for name in ("MemTotal", "MemFree", "MemAvailable", "Buffers", "Cached", "SwapTotal", "SwapFree"):
+        lines.append("# HELP node_memory_" + name + " Memory information field " + name + ".")
+        lines.append("# TYPE node_memory_" + name + " gauge")
+        lines.append("node_memory_%s %d" % (name, rnd.randint(1 << 20, 1 << 36)))
+
+    lines.append("# HELP node_cpu_seconds_total Seconds the cpus spent in each mode.")
+    lines.append("# TYPE node_cpu_seconds_total counter")
+    for cpu in range(cpus):
+        for mode in ("idle", "iowait", "irq", "nice", "softirq", "steal", "system", "user"):
+            lines.append('node_cpu_seconds_total{cpu="%d",mode="%s"} %.2f' % (cpu, mode, rnd.random() * 1e6))
+
+    for family in ("reads_completed_total", "writes_completed_total", "read_bytes_total", "written_bytes_total", "io_time_seconds_total"):
+        lines.append("# HELP node_disk_" + family + " Disk statistics.")
+        lines.append("# TYPE node_disk_" + family + " counter")
+        for device in range(devices):
+            lines.append('node_disk_%s{device="sd%s"} %d' % (family, chr(97 + device % 26), rnd.randint(0, 1 << 40)))
+
+    lines.append("# HELP node_filesystem_avail_bytes Filesystem space available.")
+    lines.append("# TYPE node_filesystem_avail_bytes gauge")
+    for device in range(devices):
+        lines.append('node_filesystem_avail_bytes{device="/dev/sd%s1",fstype="ext4",mountpoint="/mnt/disk %d"} %d'
+                     % (chr(97 + device % 26), device, rnd.randint(0, 1 << 40)))
+
+    return "\n".join(lines) + "\n"
+
+
+def repeat(payload, size):
+    """Concatenates payload until it is at least size bytes long."""
+    copies = max(1, size // max(1, len(payload)) + 1)
+
+    return payload * copies
@@ -0,0 +1 @@
+"""Minimal stand-in for the ActiveGate plugin SDK, only used by the benchmarks."""
@@ -0,0 +1,5 @@
+class RemoteBasePlugin(object):
+    """Keeps the topology builder the plugin reports to, like the SDK does."""
+
+    def __init__(self, **kwargs):
+        self.topology_builder = kwargs.get('topology_builder')
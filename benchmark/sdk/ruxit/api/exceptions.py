@@ -0,0 +1,6 @@
+class ConfigException(Exception):
+    pass
+
+
+class AuthException(Exception):
+    pass
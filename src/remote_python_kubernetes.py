@@ -1,21 +1,392 @@
 import sys
 import os
+import re
 import json
+import codecs
+import hashlib
 import logging
 import time
+import random
+import threading
+import cProfile
+import pstats
 import requests
 import ruxit.api.exceptions
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
 from ruxit.api.base_plugin import RemoteBasePlugin
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
 from urllib.parse import urlparse
+from array import array
 from collections import defaultdict, namedtuple
 
 logger = logging.getLogger(__name__)
 
+LOG_SAMPLE_LIMIT = 10
+
+# Exporters that are scraped without prometheus.io annotations, matched
+# against the values of the usual application labels of a pod
+KNOWN_EXPORTERS = frozenset(["kube-state-metrics", "node-exporter", "prometheus-node-exporter", "etcd"])
+KNOWN_EXPORTER_LABELS = ("app", "k8s-app", "component", "app.kubernetes.io/name")
+
+# Exporters describing the whole cluster rather than their node, scraped by
+# every shard whichever node they run on
+CLUSTER_EXPORTERS = frozenset(["kube-state-metrics"])
+
+SCRAPE_BACKOFF_BASE = 60
+SCRAPE_BACKOFF_MAX = 3600
+
+# Container ports picked for direct scrapes of pods without prometheus.io/port
+METRICS_PORT_NAMES = ("metrics", "http-metrics", "https-metrics")
+
+# The cluster token is meant for the API server and the kubelets only, it is
+# never sent along when scraping pods directly
+DIRECT_SCRAPE_HEADERS = {'Authorization': None}
+
+# Hosts scraped directly that keep their keep-alive connections between polls
+DIRECT_SCRAPE_POOLS = 1024
+
+# Statuses worth another attempt; any other error status is final
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 10
+
+# Consecutive failures after which a target is not called for a while
+CIRCUIT_FAILURES = 5
+CIRCUIT_OPEN_SECONDS = 30
+
+SNAPSHOT_VERSION = 3
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_MAX_AGE = 3600
+
+# Seconds a cluster may run past its poll deadline before it is skipped
+CLUSTER_DEADLINE_GRACE = 5
+
+# Times a list is started over after its continue token expired
+LIST_RESTARTS = 3
+
+# Share of the poll deadline the pod stage waits for the services stage,
+# after which pods are scraped with the last services that were collected
+SERVICES_STAGE_BUDGET = 0.25
+
+NODE_PROPERTIES = ("node_instance_type", "node_hostname", "node_creation_timestamp", "node_info_machine_id",
+                   "node_info_system_uuid", "node_info_boot_id", "node_info_kernel_version", "node_info_os_image",
+                   "node_info_container_runtime_version", "node_info_kubelet_version", "node_info_kube_proxy_version",
+                   "node_info_operating_system", "node_info_architecture")
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+METRIC_SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{((?:[^"}]+|"[^"\\]*(?:\\.[^"\\]*)*")*)\})?[ \t]+(\S+)(?:[ \t]+(-?[0-9]+))?[ \t\r]*$')
+METRIC_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)[ \t]*=[ \t]*"([^"\\]*(?:\\.[^"\\]*)*)"')
+METRIC_LABEL_ESCAPE = re.compile(r'\\(.)')
+METRIC_LABEL_ESCAPES = {'n': '\n', '\\': '\\', '"': '"'}
+
+QUERY_URL_PERCENTILES = (50, 99)
+
+# Labels kept on a sample for routing it to its node, even when they are not
+# one of the reported dimensions of its metric
+ROUTING_LABELS = frozenset(["pod", "deployment"])
+
+# Histogram and summary families, the metrics of plugin.json with a
+# "statistic" dimension, are reported as these statistics per interval
+# instead of a series per bucket or quantile, with the number of
+# observations as the metric of the family name with _count
+FAMILY_QUANTILES = ((0.5, "p50"), (0.9, "p90"), (0.99, "p99"))
+FAMILY_SUFFIXES = ("_bucket", "_sum", "_count")
+FAMILY_LABELS = frozenset(["le", "quantile"])
+
+# Seconds the cumulative buckets of a target are kept after its last scrape
+FAMILY_TTL = 3600
+
+# Seconds the previous value of a relative series is kept after it was last
+# reported, and the least number of seconds between two eviction passes
+COUNTER_TTL = 900
+COUNTER_EVICT_INTERVAL = 60
+
+
+class Sample(object):
+    """A single metric sample, passed as is from the parser to reporting.
+
+    Keys and label strings are interned, labels are kept as a tuple of
+    (name, value) pairs and the value is parsed to a float exactly once.
+    dimension_labels holds the labels that are reported when some of them
+    were pruned, None when all of them are reported. Samples over the
+    max_series cap are not reported but still feed the aggregates.
+    """
+
+    __slots__ = ('key', 'labels', 'value', 'timestamp', 'relative', 'dimension_labels', 'reported')
+
+    def __init__(self, key, labels, value, timestamp=None, relative=False, dimension_labels=None):
+        self.key = key
+        self.labels = labels
+        self.value = value
+        self.timestamp = timestamp
+        self.relative = relative
+        self.dimension_labels = dimension_labels
+        self.reported = True
+
+    @property
+    def dimensions(self):
+        return dict(self.labels if self.dimension_labels is None else self.dimension_labels)
+
+    def __repr__(self):
+        return "Sample(%r, %r, %r, %r, %r, %r)" % (self.key, self.labels, self.value, self.timestamp, self.relative, self.dimension_labels)
+
+
+class ListError(Exception):
+    """A list request failed or the list it returned is incomplete."""
+
+
+class PollStats(object):
+    """Timings, counters and query_url latencies of one cluster and poll.
+
+    Scrape workers update it concurrently, so every update takes the lock.
+    Timings of stages running in several workers at once are summed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.latencies = []
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.timings[stage] += seconds
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def percentiles(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+        if not latencies:
+            return {}
+
+        return dict((percentile, latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)])
+                    for percentile in QUERY_URL_PERCENTILES)
+
+    def samples(self, shard):
+        # Self-monitoring samples reported on the group of the cluster, in
+        # milliseconds for timings and latencies, told apart by shard as
+        # every shard reports its own
+        shard = ("shard", str(shard))
+
+        with self.lock:
+            timings = list(self.timings.items())
+            counters = list(self.counters.items())
+
+        samples = [Sample("plugin_stage_duration", (("stage", stage), shard), seconds * 1000) for stage, seconds in timings]
+        samples.extend(Sample("plugin_counter", (("counter", counter), shard), float(value)) for counter, value in counters)
+        samples.extend(Sample("plugin_query_url_latency", (("percentile", "p" + str(percentile)), shard), seconds * 1000)
+                       for percentile, seconds in sorted(self.percentiles().items()))
+
+        return samples
+
+    def as_dict(self):
+        with self.lock:
+            result = {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+        result['query_url_latency'] = dict(("p" + str(percentile), seconds) for percentile, seconds in self.percentiles().items())
+
+        return result
+
+
+class CounterStore(object):
+    """Previous values of the relative series of a cluster, across polls.
+
+    Every series gets a slot in flat arrays of values and last seen times,
+    looked up by its (element, key, dimensions) id. Slots of series that were
+    not seen for COUNTER_TTL seconds are freed and reused for new series.
+    """
+
+    def __init__(self, ttl=COUNTER_TTL):
+        self.ttl = ttl
+        self.slots = {}
+        self.series = []
+        self.values = array('d')
+        self.seen = array('d')
+        self.free = []
+        self.evicted = 0.0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def deltas(self, series, values, now):
+        # One pass over all series of a poll: the difference to the previous
+        # value, the value itself after a counter reset and None for series
+        # seen for the first time
+        slots = self.slots
+        previous_values = self.values
+        seen = self.seen
+        results = []
+
+        for series_id, value in zip(series, values):
+            slot = slots.get(series_id)
+
+            if slot is None:
+                slot = self.allocate(series_id)
+                results.append(None)
+            else:
+                previous = previous_values[slot]
+                results.append(value - previous if value >= previous else value)
+
+            previous_values[slot] = value
+            seen[slot] = now
+
+        if now - self.evicted >= COUNTER_EVICT_INTERVAL:
+            self.evict(now)
+
+        return results
+
+    def allocate(self, series_id):
+        if self.free:
+            slot = self.free.pop()
+            self.series[slot] = series_id
+        else:
+            slot = len(self.series)
+            self.series.append(series_id)
+            self.values.append(0.0)
+            self.seen.append(0.0)
+
+        self.slots[series_id] = slot
+
+        return slot
+
+    def evict(self, now):
+        expired = now - self.ttl
+        seen = self.seen
+        series = self.series
+
+        for slot in range(len(series)):
+            if series[slot] is not None and seen[slot] < expired:
+                del self.slots[series[slot]]
+                series[slot] = None
+                self.free.append(slot)
+
+        self.evicted = now
+
+
+def unescape_label(match):
+    return METRIC_LABEL_ESCAPES.get(match.group(1), match.group(0))
+
+
+def parse_exposition(lines, types=None, keys=None):
+    """Single pass tokenizer for the Prometheus text exposition format.
+
+    Yields a Sample per sample line, with the timestamp as an int in
+    milliseconds or None. Metric types announced by '# TYPE' lines are
+    collected into types when a dict is passed in. When keys is given, lines
+    of any other metric are skipped as soon as their name has been read.
+    """
+    match_sample = METRIC_SAMPLE.match
+    find_labels = METRIC_LABEL.findall
+    intern = sys.intern
+
+    for line in lines:
+        if not line:
+            continue
+
+        if line[0] == '#':
+            if types is not None and line.startswith('# TYPE '):
+                fields = line.split(None, 3)
+                if len(fields) == 4:
+                    types[fields[2]] = fields[3].strip()
+            continue
+
+        brace = line.find('{')
+
+        # The name ends at the first blank, tab or brace; a line with none of
+        # them has no value and is skipped
+        if keys is not None:
+            end = line.find(' ')
+            tab = line.find('\t', 0, end) if end != -1 else line.find('\t')
+            if tab != -1:
+                end = tab
+            if brace != -1 and (end == -1 or brace < end):
+                end = brace
+            if end == -1 or line[:end] not in keys:
+                continue
+
+        # Without escape sequences every '"' delimits a label value, so the
+        # labels are split on them; only lines with escapes go through the
+        # regular expressions
+        if '\\' in line:
+            match = match_sample(line)
+            if match is None:
+                continue
+
+            name, block, value, timestamp = match.groups()
+            labels = tuple([(intern(label), intern(METRIC_LABEL_ESCAPE.sub(unescape_label, label_value))) for label, label_value in find_labels(block or "")])
+        else:
+            if brace == -1:
+                fields = line.split()
+                labels = ()
+            else:
+                close = line.rfind('}')
+                parts = line[brace + 1:close].split('"')
+                if close < brace or len(parts) % 2 == 0:
+                    continue
+
+                labels = tuple([(intern(parts[index].strip(' \t,=')), intern(parts[index + 1])) for index in range(0, len(parts) - 1, 2)])
+                fields = [line[:brace]] + line[close + 1:].split()
+
+            if len(fields) == 2:
+                name, value, timestamp = fields[0], fields[1], None
+            elif len(fields) == 3:
+                name, value, timestamp = fields
+            else:
+                continue
+
+        try:
+            value = float(value)
+            timestamp = int(timestamp) if timestamp else None
+        except ValueError:
+            continue
+
+        yield Sample(intern(name), labels, value, timestamp)
+
+
+def bucket_quantile(quantile, buckets):
+    """Estimates a quantile from cumulative (upper bound, count) buckets.
+
+    Buckets are sorted by upper bound and end with +Inf; the quantile is
+    interpolated linearly within its bucket like Prometheus does, and falls
+    back to the highest finite bound when it lands in the +Inf bucket.
+    """
+    total = buckets[-1][1]
+    if total <= 0:
+        return None
+
+    rank = quantile * total
+    lower_bound, lower_count = 0.0, 0.0
+
+    for upper_bound, count in buckets:
+        if count >= rank:
+            if upper_bound == float("inf"):
+                return lower_bound
+            if count == lower_count:
+                return upper_bound
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+
+        lower_bound, lower_count = upper_bound, count
+
+    return lower_bound
+
 
 #class RemoteKubernetesPlugin():
 class RemoteKubernetesPlugin(RemoteBasePlugin):
     def initialize(self, **kwargs):
+        self.debug = False
+        self.log_samples = {}
+        self.log_samples_lock = threading.Lock()
+
         try:
             self.args = {}
 
@@ -23,24 +394,160 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
             self.args['url'] = kwargs['config']['url']
             self.args['token'] = kwargs['config']['token']
             self.args['debug'] = kwargs['config']['debug']
+            self.debug = self.args['debug'] == "true"
 
             if 'dev' in kwargs['config']:
                 self.args['dev'] = "true"
             else:
                 self.args['dev'] = "false"
 
+            self.args['list_only'] = str(kwargs['config'].get('list_only', "true"))
+
+            self.args['scrape_discovery'] = str(kwargs['config'].get('scrape_discovery', "true"))
+            self.args['direct_scrape'] = str(kwargs['config'].get('direct_scrape', "false"))
+            self.args['kubelet_scrape'] = str(kwargs['config'].get('kubelet_scrape', "false"))
+            self.args['kubelet_port'] = int(kwargs['config'].get('kubelet_port', 10250))
+            self.args['watch'] = str(kwargs['config'].get('watch', "false"))
+            self.args['page_size'] = int(kwargs['config'].get('page_size', 500))
+
+            self.args['max_workers'] = int(kwargs['config'].get('max_workers', 32))
+            self.args['max_in_flight'] = int(kwargs['config'].get('max_in_flight', 16))
+            self.args['poll_deadline'] = float(kwargs['config'].get('poll_deadline', 45))
+
+            self.args['pool_size'] = int(kwargs['config'].get('pool_size', 32))
+            self.args['connect_timeout'] = float(kwargs['config'].get('connect_timeout', 2))
+            self.args['read_timeout'] = float(kwargs['config'].get('read_timeout', 2))
+            self.args['retries'] = int(kwargs['config'].get('retries', 1))
+
+            self.args['node_interval'] = int(kwargs['config'].get('node_interval', 600))
+            self.args['service_interval'] = int(kwargs['config'].get('service_interval', 300))
+            self.args['property_resync_interval'] = int(kwargs['config'].get('property_resync_interval', 3600))
+
+            self.args['stats_file'] = str(kwargs['config'].get('stats_file', ""))
+            self.args['profile_file'] = str(kwargs['config'].get('profile_file', ""))
+            self.args['snapshot_file'] = str(kwargs['config'].get('snapshot_file', ""))
+
+            self.args['exclude_namespaces'] = [namespace.strip() for namespace in str(kwargs['config'].get('exclude_namespaces', "")).split(",") if namespace.strip()]
+            self.args['namespaces'] = [namespace.strip() for namespace in str(kwargs['config'].get('namespaces', "")).split(",")
+                                       if namespace.strip() and namespace.strip() not in self.args['exclude_namespaces']]
+            self.args['pod_label_selector'] = str(kwargs['config'].get('pod_label_selector', ""))
+            self.args['pod_field_selector'] = str(kwargs['config'].get('pod_field_selector', ""))
+            self.args['service_label_selector'] = str(kwargs['config'].get('service_label_selector', ""))
+            self.args['service_field_selector'] = str(kwargs['config'].get('service_field_selector', ""))
+
+            self.args['shard_index'] = int(kwargs['config'].get('shard_index', 0))
+            self.args['shard_count'] = max(1, int(kwargs['config'].get('shard_count', 1)))
+            # A shard outside the shard count would own no nodes at all
+            if not 0 <= self.args['shard_index'] < self.args['shard_count']:
+                raise ruxit.api.exceptions.ConfigException("shard_index must be between 0 and " + str(self.args['shard_count'] - 1))
+
+            self.args['clusters'] = self.initialize_clusters(kwargs['config'])
+
             self.args['metrics'] = self.initialize_metrics(kwargs['json_config']['metrics'])
+            self.args['metric_index'] = dict((metric['key'], metric) for metric in self.args['metrics'])
+            self.args['families'] = self.initialize_families(self.args['metrics'])
+            self.args['metric_keys'] = frozenset(metric['key'] for metric in self.args['metrics']
+                                                 if metric['aggregate'] is None and metric['type'] == "KubernetesStats") | frozenset(self.args['families'])
+            self.args['aggregates'] = self.initialize_aggregates(self.args['metrics'])
+            self.args['aggregate_sources'] = frozenset(metric['aggregate']['metric'] for metric in self.args['metrics'] if metric['aggregate'] is not None)
+            for metric in self.args['metrics']:
+                metric['aggregate_source'] = metric['key'] in self.args['aggregate_sources']
+
+            self.args['max_series'] = int(kwargs['config'].get('max_series', 5000))
+
+            self.log("[remotekubernetesplugin.initialize] ID: %s", "info", self.args['id'])
+            self.log("[remotekubernetesplugin.initialize] URL: %s", "info", self.args['url'])
+            self.log("[remotekubernetesplugin.initialize] TOKEN: %s", "info", self.args['token'])
+            self.log("[remotekubernetesplugin.initialize] DEBUG: %s", "info", self.args['debug'])
+            self.log("[remotekubernetesplugin.initialize] METRICS: %s", "info", self.args['metrics'])
+            self.log("[remotekubernetesplugin.initialize] MAX_SERIES: %s", "info", self.args['max_series'])
+            self.log("[remotekubernetesplugin.initialize] DEV: %s", "info", self.args['dev'])
+            self.log("[remotekubernetesplugin.initialize] LIST_ONLY: %s", "info", self.args['list_only'])
+            self.log("[remotekubernetesplugin.initialize] SCRAPE_DISCOVERY: %s", "info", self.args['scrape_discovery'])
+            self.log("[remotekubernetesplugin.initialize] DIRECT_SCRAPE: %s", "info", self.args['direct_scrape'])
+            self.log("[remotekubernetesplugin.initialize] KUBELET_SCRAPE: %s", "info", self.args['kubelet_scrape'])
+            self.log("[remotekubernetesplugin.initialize] KUBELET_PORT: %s", "info", self.args['kubelet_port'])
+            self.log("[remotekubernetesplugin.initialize] WATCH: %s", "info", self.args['watch'])
+            self.log("[remotekubernetesplugin.initialize] PAGE_SIZE: %s", "info", self.args['page_size'])
+            self.log("[remotekubernetesplugin.initialize] MAX_WORKERS: %s", "info", self.args['max_workers'])
+            self.log("[remotekubernetesplugin.initialize] MAX_IN_FLIGHT: %s", "info", self.args['max_in_flight'])
+            self.log("[remotekubernetesplugin.initialize] POLL_DEADLINE: %s", "info", self.args['poll_deadline'])
+            self.log("[remotekubernetesplugin.initialize] POOL_SIZE: %s", "info", self.args['pool_size'])
+            self.log("[remotekubernetesplugin.initialize] CONNECT_TIMEOUT: %s", "info", self.args['connect_timeout'])
+            self.log("[remotekubernetesplugin.initialize] READ_TIMEOUT: %s", "info", self.args['read_timeout'])
+            self.log("[remotekubernetesplugin.initialize] RETRIES: %s", "info", self.args['retries'])
+            self.log("[remotekubernetesplugin.initialize] NODE_INTERVAL: %s", "info", self.args['node_interval'])
+            self.log("[remotekubernetesplugin.initialize] SERVICE_INTERVAL: %s", "info", self.args['service_interval'])
+            self.log("[remotekubernetesplugin.initialize] PROPERTY_RESYNC_INTERVAL: %s", "info", self.args['property_resync_interval'])
+            self.log("[remotekubernetesplugin.initialize] STATS_FILE: %s", "info", self.args['stats_file'])
+            self.log("[remotekubernetesplugin.initialize] PROFILE_FILE: %s", "info", self.args['profile_file'])
+            self.log("[remotekubernetesplugin.initialize] SNAPSHOT_FILE: %s", "info", self.args['snapshot_file'])
+            self.log("[remotekubernetesplugin.initialize] NAMESPACES: %s", "info", self.args['namespaces'])
+            self.log("[remotekubernetesplugin.initialize] EXCLUDE_NAMESPACES: %s", "info", self.args['exclude_namespaces'])
+            self.log("[remotekubernetesplugin.initialize] POD_LABEL_SELECTOR: %s", "info", self.args['pod_label_selector'])
+            self.log("[remotekubernetesplugin.initialize] POD_FIELD_SELECTOR: %s", "info", self.args['pod_field_selector'])
+            self.log("[remotekubernetesplugin.initialize] SERVICE_LABEL_SELECTOR: %s", "info", self.args['service_label_selector'])
+            self.log("[remotekubernetesplugin.initialize] SERVICE_FIELD_SELECTOR: %s", "info", self.args['service_field_selector'])
+            self.log("[remotekubernetesplugin.initialize] SHARD_INDEX: %s", "info", self.args['shard_index'])
+            self.log("[remotekubernetesplugin.initialize] SHARD_COUNT: %s", "info", self.args['shard_count'])
+            self.log("[remotekubernetesplugin.initialize] CLUSTERS: %s", "info", [cluster['id'] for cluster in self.args['clusters']])
+
+            for cluster in self.args['clusters']:
+                cluster['session'] = self.create_session(cluster)
+                cluster['scrape_failures'] = {}
+                cluster['circuits'] = {}
+                cluster['circuit_lock'] = threading.Lock()
+                cluster['inventory'] = self.create_inventory()
+                cluster['stages'] = self.create_stages()
+                cluster['node_fingerprints'] = {}
+                cluster['family_buckets'] = {}
+                cluster['counters'] = CounterStore()
+                cluster['stats'] = PollStats()
+                cluster['deadline'] = 0
+                cluster['future'] = None
+
+            # Scrape requests of all clusters share one worker pool, while every
+            # cluster gets a thread of its own to list and scrape concurrently
+            self.executor = ThreadPoolExecutor(max_workers=self.args['max_workers'])
+            self.cluster_executor = ThreadPoolExecutor(max_workers=max(1, len(self.args['clusters'])))
+            self.stage_executor = ThreadPoolExecutor(max_workers=max(1, 2 * len(self.args['clusters'])))
+
+            self.stop_event = threading.Event()
+
+            self.profiles = []
+            self.profile_lock = threading.Lock()
+
+            self.snapshot_time = time.time()
+            if self.args['snapshot_file']:
+                self.load_snapshot()
+
+            return
+        except ruxit.api.exceptions.ConfigException:
+            # Shown on the endpoint by the ActiveGate
+            raise
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.initialize] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def close(self, **kwargs):
+        try:
+            self.log("[remotekubernetesplugin.close]", "info")
+
+            self.stop_event.set()
 
-            self.log("[remotekubernetesplugin.initialize] ID: " + str(self.args['id']), "info")
-            self.log("[remotekubernetesplugin.initialize] URL: " + str(self.args['url']), "info")
-            self.log("[remotekubernetesplugin.initialize] TOKEN: " + str(self.args['token']), "info")
-            self.log("[remotekubernetesplugin.initialize] DEBUG: " + str(self.args['debug']), "info")
-            self.log("[remotekubernetesplugin.initialize] METRICS: " + str(self.args['metrics']), "info")
-            self.log("[remotekubernetesplugin.initialize] DEV: " + str(self.args['dev']), "info")
+            if self.args['snapshot_file']:
+                self.write_snapshot()
+
+            self.executor.shutdown(wait=False)
+            self.cluster_executor.shutdown(wait=False)
+            self.stage_executor.shutdown(wait=False)
+            for cluster in self.args['clusters']:
+                cluster['session'].close()
 
             return
         except Exception as exc:
-            self.log("[remotekubernetesplugin.initialize] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.close] EXCEPTION: %s", "info", exc)
 
             return
 
@@ -51,13 +558,137 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
             for metric in json_config_metrics:
                 result = {'entity': 'CUSTOM_DEVICE', 'key': metric['timeseries']['key'],
                           'dimensions': metric['timeseries']['dimensions'], 'type': metric['source']['type'],
-                          'relative': metric['source']['relative']}
+                          'relative': metric['source']['relative'], 'aggregate': metric['source'].get('aggregate'),
+                          'dimension_set': frozenset(metric['timeseries']['dimensions'])}
 
                 results.append(result)
 
             return results
         except Exception as exc:
-            self.log("[remotekubernetesplugin.initialize_metrics] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.initialize_metrics] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def initialize_families(self, metrics):
+        try:
+            results = {}
+            metric_index = dict((metric['key'], metric) for metric in metrics)
+
+            # Every sample name of a family points at the family name, the
+            # metric of its statistics and the metric of its count, if any
+            for metric in metrics:
+                if "statistic" not in metric['dimension_set'] or metric['type'] != "KubernetesStats":
+                    continue
+
+                family = metric['key']
+                for suffix in ("",) + FAMILY_SUFFIXES:
+                    results[sys.intern(family + suffix)] = (family, metric, metric_index.get(family + "_count"))
+
+            return results
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.initialize_families] EXCEPTION: %s", "info", exc)
+
+            return {}
+
+    def initialize_clusters(self, config):
+        try:
+            clusters = []
+
+            # The single cluster of the id/url/token properties comes first,
+            # followed by any cluster of the JSON list in the clusters property.
+            # An invalid entry is logged and skipped, the others are monitored.
+            if config.get('url'):
+                cluster = self.initialize_cluster({'id': config.get('id'), 'url': config['url'], 'token': config.get('token')})
+                if cluster is not None:
+                    clusters.append(cluster)
+
+            entries = []
+            if config.get('clusters'):
+                try:
+                    entries = json.loads(config['clusters'])
+                    if not isinstance(entries, list):
+                        raise ValueError("Expected a JSON list")
+                except Exception as exc:
+                    self.log("[remotekubernetesplugin.initialize_clusters] INVALID CLUSTERS: %s", "info", exc)
+
+                    entries = []
+
+            for entry in entries:
+                cluster = self.initialize_cluster(entry)
+                if cluster is None:
+                    continue
+
+                if any(known['id'] == cluster['id'] for known in clusters):
+                    self.log("[remotekubernetesplugin.initialize_clusters] DUPLICATE CLUSTER: %s", "info", cluster['id'])
+                    continue
+
+                clusters.append(cluster)
+
+            return clusters
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.initialize_clusters] EXCEPTION: %s", "info", exc)
+
+            return []
+
+    def initialize_cluster(self, entry):
+        try:
+            cluster = {}
+
+            cluster['id'] = str(entry['id'])
+            cluster['url'] = str(entry['url']).rstrip("/")
+            cluster['token'] = str(entry['token'])
+            cluster['poll_deadline'] = float(entry.get('poll_deadline', self.args['poll_deadline']))
+            cluster['max_in_flight'] = int(entry.get('max_in_flight', self.args['max_in_flight']))
+
+            for key in ('id', 'url', 'token'):
+                if entry[key] is None or not cluster[key]:
+                    raise ValueError("Missing " + key)
+
+            return cluster
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.initialize_cluster] INVALID CLUSTER %s: %s", "info", entry.get('id') if isinstance(entry, dict) else entry, exc)
+
+            return
+
+    def create_inventory(self):
+        inventory = {}
+
+        # One watch per list path, as included namespaces are watched one by
+        # one and a resourceVersion only applies to the list it came from
+        for resource in ("nodes", "services", "pods"):
+            inventory[resource] = {}
+            for path in self.list_paths(resource):
+                inventory[resource][path] = {'items': {}, 'lock': threading.Lock(), 'thread': None, 'synced': False,
+                                             'resource_version': None, 'relists': 0, 'events': 0,
+                                             'last_sync': 0, 'last_event': 0}
+
+        return inventory
+
+    def create_stages(self):
+        stages = {}
+
+        for stage in ("nodes", "services"):
+            stages[stage] = {'result': None, 'time': 0, 'future': None, 'runs': 0, 'overruns': 0}
+
+        return stages
+
+    def initialize_aggregates(self, metrics):
+        try:
+            # scope -> source metric key -> derived metrics computed from it,
+            # plus the derived metrics of every scope in plugin.json order
+            aggregates = {'element': defaultdict(list), 'group': defaultdict(list), 'order': {'element': [], 'group': []}}
+
+            for metric in metrics:
+                if metric['aggregate'] is None:
+                    continue
+
+                for scope in metric['aggregate'].get('scope', ["element"]):
+                    aggregates[scope][metric['aggregate']['metric']].append(metric)
+                    aggregates['order'][scope].append(metric)
+
+            return aggregates
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.initialize_aggregates] EXCEPTION: %s", "info", exc)
 
             return
 
@@ -67,72 +698,260 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
 
             start_time = time.time()
 
-            data = {'cluster': self.query_cluster(),
-                    'nodes': self.query_nodes(),
-                    'services': self.query_services(),
-                    'pods': self.query_pods()}
+            profile = None
+            if self.args['profile_file']:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as exc:
+                    self.log("[remotekubernetesplugin.query] PROFILER NOT STARTED: %s", "info", exc)
+                    profile = None
+
+            polled = []
+            for cluster in self.args['clusters']:
+                # A cluster still running from an earlier poll is not submitted
+                # again, so it never takes the worker of another cluster
+                if cluster['future'] is not None and not cluster['future'].done():
+                    self.log("[remotekubernetesplugin.query] CLUSTER %s STILL RUNNING", "info", cluster['id'])
+                    continue
+
+                cluster['deadline'] = start_time + cluster['poll_deadline']
+                cluster['stats'] = PollStats()
+                cluster['future'] = self.submit(self.cluster_executor, self.query_data, cluster)
+                polled.append(cluster)
+
+            # Clusters are collected concurrently but reported one after the
+            # other from this thread; a cluster that fails or overruns its
+            # deadline is skipped without holding back the others
+            for cluster in polled:
+                try:
+                    data = cluster['future'].result(timeout=max(0, cluster['deadline'] + CLUSTER_DEADLINE_GRACE - time.time()))
+                except TimeoutError:
+                    self.log("[remotekubernetesplugin.query] CLUSTER %s TIMED OUT", "info", cluster['id'])
+                    continue
+
+                if data is None:
+                    continue
 
-            self.report_topology(data)
+                self.report_topology(cluster, data)
+
+                if self.debug:
+                    self.log("[remotekubernetesplugin.query] SESSION %s: %s", "info", cluster['id'], json.dumps(self.session_stats(cluster)))
+
+            self.flush_log_samples()
+
+            if self.args['stats_file']:
+                self.write_stats()
+
+            if self.args['snapshot_file'] and time.time() - self.snapshot_time >= SNAPSHOT_INTERVAL:
+                self.write_snapshot()
+
+            if profile is not None:
+                profile.disable()
+                self.write_profile(profile)
 
             end_time = time.time()
 
-            print("--- STATISTICS ---")
-            print("--- EXECUTION TIME: %s SECONDS ---" % (end_time - start_time))
+            self.log("[remotekubernetesplugin.query] EXECUTION TIME: %s SECONDS", "info", end_time - start_time)
+
+            return
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.query] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def query_data(self, cluster):
+        try:
+            self.log("[remotekubernetesplugin.query_data] %s", "info", cluster['id'])
+
+            if self.args['watch'] == "true":
+                self.start_watches(cluster)
+                if self.debug:
+                    self.log("[remotekubernetesplugin.query_data] INVENTORY %s: %s", "info", cluster['id'], json.dumps(self.inventory_stats(cluster)))
+
+            # Nodes and services run as stages of their own next to the pods,
+            # each refreshed only once its interval has passed
+            nodes = self.run_stage(cluster, "nodes", self.query_nodes, self.args['node_interval'])
+            services = self.run_stage(cluster, "services", self.query_services, self.args['service_interval'])
+
+            data = {'cluster': self.query_cluster(cluster)}
+
+            data['services'] = self.stage_result(cluster, "services", services,
+                                                 min(time.time() + cluster['poll_deadline'] * SERVICES_STAGE_BUDGET, cluster['deadline']))
+            # Kubelets are scraped along with the pods, from the last node list
+            # that completed rather than waiting for this poll's nodes stage.
+            # A shard lists the pods of its nodes, so it has to wait for the
+            # first node list.
+            shard_nodes = cluster['stages']['nodes']['result']
+            if shard_nodes is None and self.args['shard_count'] > 1:
+                shard_nodes = self.stage_result(cluster, "nodes", nodes, cluster['deadline'])
+
+            start_time = time.time()
+            data['pods'] = self.query_pods(cluster, data['services'], shard_nodes)
+            cluster['stats'].add_time("pods", time.time() - start_time)
+
+            data['nodes'] = self.stage_result(cluster, "nodes", nodes, cluster['deadline'])
+
+            if data['nodes'] is None:
+                self.log("[remotekubernetesplugin.query_data] NO NODES FOR %s", "info", cluster['id'])
+
+                return
+
+            return data
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.query_data] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def run_stage(self, cluster, stage, func, interval):
+        try:
+            state = cluster['stages'][stage]
+
+            # A stage still running from an earlier poll is not submitted
+            # again, its result is picked up once it completes
+            if state['future'] is not None and not state['future'].done():
+                return state['future']
+
+            if state['result'] is not None and time.time() - state['time'] < interval:
+                return
+
+            state['future'] = self.submit(self.stage_executor, self.collect_stage, cluster, stage, func)
+            state['runs'] = state['runs'] + 1
+
+            return state['future']
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.run_stage] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def collect_stage(self, cluster, stage, func):
+        try:
+            start_time = time.time()
+
+            result = func(cluster)
+            cluster['stats'].add_time(stage, time.time() - start_time)
+
+            # Objects built from the list fail the same way on every poll, so
+            # they are left out; only objects that were fetched one by one
+            # can be missing for a transient failure
+            if result is not None and self.args['list_only'] == "true" and None in result:
+                self.log("[remotekubernetesplugin.collect_stage] STAGE %s OF %s DROPPED %s OBJECTS", "info",
+                         stage, cluster['id'], result.count(None))
+                result = [item for item in result if item is not None]
+
+            # Only complete lists are kept for the interval; after a failed
+            # refresh the previous result is used and the stage runs again on
+            # the next poll
+            if result is None or None in result:
+                self.log("[remotekubernetesplugin.collect_stage] STAGE %s OF %s FAILED", "info", stage, cluster['id'])
+
+                return cluster['stages'][stage]['result']
+
+            cluster['stages'][stage]['result'] = result
+            cluster['stages'][stage]['time'] = start_time
+
+            return result
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.collect_stage] EXCEPTION: %s", "info", exc)
 
             return
+
+    def stage_result(self, cluster, stage, future, deadline):
+        try:
+            state = cluster['stages'][stage]
+
+            # Whatever finished in time is used, otherwise the last result
+            # that was collected, which is None until a stage first completes
+            if future is not None:
+                done, not_done = wait([future], timeout=max(0, deadline - time.time()))
+                if not_done:
+                    state['overruns'] = state['overruns'] + 1
+                    self.log("[remotekubernetesplugin.stage_result] STAGE %s OF %s OVERRAN ITS DEADLINE", "info", stage, cluster['id'])
+
+            return state['result']
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.stage_result] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_cluster(self):
+    def query_cluster(self, cluster):
         try:
             self.log("[remotekubernetesplugin.query_cluster]", "info")
 
-            cluster = {}
+            result = {}
 
-            cluster['cluster_id'] = str(self.args['id'])
-            cluster['cluster_url'] = str(self.args['url'])
-            cluster['cluster_name'] = str(self.args['id']) + " (" + str(self.args['url']) + ")"
+            result['cluster_id'] = str(cluster['id'])
+            result['cluster_url'] = str(cluster['url'])
+            result['cluster_name'] = str(cluster['id']) + " (" + str(cluster['url']) + ")"
 
-            return cluster
+            return result
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_cluster] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.query_cluster] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_nodes(self):
+    def query_nodes(self, cluster):
         try:
             self.log("[remotekubernetesplugin.query_nodes]", "info")
 
-            nodes = []
+            if self.args['watch'] == "true" and self.inventory_synced(cluster, "nodes"):
+                return self.shard_nodes(self.read_inventory(cluster, "nodes"))
 
-            url = str(self.args['url']) + "/api/v1/nodes"
-            content = self.query_url(url)
-            json_data = json.loads(content)
+            nodes = []
 
-            for item in json_data['items']:
-                self_link = item['metadata']['selfLink']
-                nodes.append(self.query_node(self_link))
+            for item in self.query_list(cluster, "/api/v1/nodes"):
+                if self.args['list_only'] == "true":
+                    nodes.append(self.build_node(cluster, item))
+                else:
+                    nodes.append(self.query_node(cluster, self.self_link(item, "nodes")))
 
-            return nodes
+            return self.shard_nodes(nodes)
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_nodes] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.query_nodes] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_node(self, self_link):
+    def shard_nodes(self, nodes):
         try:
-            self.log("[remotekubernetesplugin.query_node]", "info")
+            if self.args['shard_count'] == 1:
+                return nodes
 
-            node = {}
+            return [node for node in nodes if node is not None and self.node_shard(node['node_id']) == self.args['shard_index']]
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.shard_nodes] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def node_shard(self, node_id):
+        # Rendezvous hashing: a node belongs to the shard with the highest
+        # hash of node UID and shard, so a change of shard_count only moves
+        # the nodes of the shards that were added or removed
+        return max(range(self.args['shard_count']),
+                   key=lambda shard: hashlib.md5((node_id + "/" + str(shard)).encode("utf-8")).digest())
+
+    def query_node(self, cluster, self_link):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_node]", "info")
 
-            url = str(self.args['url']) + str(self_link)
-            content = self.query_url(url)
+            url = str(cluster['url']) + str(self_link)
+            content = self.query_url(cluster, url)
             json_data = json.loads(content)
 
+            return self.build_node(cluster, json_data)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_node] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def build_node(self, cluster, json_data):
+        try:
+            self.log_sampled("[remotekubernetesplugin.build_node]", "info")
+
+            node = {}
+
             node['node_id'] = json_data['metadata']['uid']
             node['node_name'] = json_data['metadata']['name']
+            node['node_resource_version'] = json_data['metadata'].get('resourceVersion')
 
             for address in json_data['status']['addresses']:
                 node['node_external_ip'] = address['address']
@@ -140,6 +959,12 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
                 if address['type'] == "ExternalIP":
                     break
 
+            node['node_internal_ip'] = None
+            for address in json_data['status']['addresses']:
+                if address['type'] == "InternalIP":
+                    node['node_internal_ip'] = address['address']
+                    break
+
             try:
                 node['node_role'] = json_data['metadata']['labels']['kubernetes.io/role']
             except Exception as exc:
@@ -212,304 +1037,1318 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
 
             return node
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_node] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.build_node] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_services(self):
+    def query_services(self, cluster):
         try:
             self.log("[remotekubernetesplugin.query_services]", "info")
 
-            services = []
+            if self.args['watch'] == "true" and self.inventory_synced(cluster, "services"):
+                return self.read_inventory(cluster, "services")
 
-            url = str(self.args['url']) + "/api/v1/services"
-            content = self.query_url(url)
-            json_data = json.loads(content)
+            services = []
 
-            for item in json_data['items']:
-                self_link = item['metadata']['selfLink']
-                services.append(self.query_service(self_link))
+            for item in self.query_scoped_list(cluster, "services"):
+                if self.args['list_only'] == "true":
+                    services.append(self.build_service(cluster, item))
+                else:
+                    services.append(self.query_service(cluster, self.self_link(item, "services")))
 
             return services
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_services] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.query_services] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_service(self, self_link):
+    def query_service(self, cluster, self_link):
         try:
-            self.log("[remotekubernetesplugin.query_service]", "info")
+            self.log_sampled("[remotekubernetesplugin.query_service]", "info")
 
-            service = {}
-
-            url = str(self.args['url']) + str(self_link)
-            content = self.query_url(url)
+            url = str(cluster['url']) + str(self_link)
+            content = self.query_url(cluster, url)
             json_data = json.loads(content)
 
+            return self.build_service(cluster, json_data)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_service] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def build_service(self, cluster, json_data):
+        try:
+            self.log_sampled("[remotekubernetesplugin.build_service]", "info")
+
+            service = {}
+
             service['service_id'] = json_data['metadata']['uid']
-            service['service_self_link'] = json_data['metadata']['selfLink']
+            service['service_name'] = json_data['metadata']['name']
+            service['service_namespace'] = json_data['metadata'].get('namespace')
+            service['service_self_link'] = self.self_link(json_data, "services")
+            service['service_scrape'] = self.scrape_config(json_data['metadata'].get('annotations'))
 
             return service
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_service] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.build_service] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_pods(self):
+    def query_pods(self, cluster, services=None, nodes=None):
         try:
             self.log("[remotekubernetesplugin.query_pods]", "info")
 
-            pods = []
+            if self.args['watch'] == "true" and self.inventory_synced(cluster, "pods"):
+                pods = [dict(pod) for pod in self.read_inventory(cluster, "pods")]
 
-            url = str(self.args['url']) + "/api/v1/pods"
-            content = self.query_url(url)
-            json_data = json.loads(content)
+                if self.args['shard_count'] > 1:
+                    node_names = set(node['node_name'] for node in nodes or [] if node is not None)
+                    pods = [pod for pod in pods if pod is not None and (pod['pod_node_name'] in node_names or pod.get('pod_cluster_exporter'))]
+            elif self.args['list_only'] == "true":
+                pods = [self.build_pod(cluster, item) for item in self.query_pod_items(cluster, nodes)]
+            else:
+                self_links = [self.self_link(item, "pods") for item in self.query_pod_items(cluster, nodes)]
+                pods = self.scrape(cluster, self.query_pod, self_links)
 
-            for item in json_data['items']:
-                self_link = item['metadata']['selfLink']
-                pods.append(self.query_pod(self_link))
+            pods = [pod for pod in pods if pod is not None]
 
-            return pods
+            if self.args['kubelet_scrape'] == "true" and nodes is not None:
+                pods.extend(self.kubelet_targets(cluster, nodes))
+
+            return self.scrape_pods(cluster, pods, services)
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_pods] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.query_pods] EXCEPTION: %s", "info", exc)
 
             return
 
-    def query_pod(self, self_link):
+    def query_pod_items(self, cluster, nodes):
         try:
-            self.log("[remotekubernetesplugin.query_pod]", "info")
-
-            pod = {}
+            # Pods are listed within the poll deadline, so a slow list leaves
+            # the nodes to be reported without their pods
+            if self.args['shard_count'] == 1:
+                return self.query_scoped_list(cluster, "pods", deadline=cluster['deadline'])
 
-            url = str(self.args['url']) + str(self_link)
-            content = self.query_url(url)
-            json_data = json.loads(content)
+            # A shard lists the pods of each of its nodes, and the cluster
+            # exporters wherever they run
+            items = {}
 
-            pod['pod_id'] = json_data['metadata']['uid']
-            pod['pod_name'] = json_data['metadata']['name']
-            pod['pod_self_link'] = json_data['metadata']['selfLink']
+            if nodes is None:
+                raise ListError("No nodes to list the pods of")
 
-            try:
-                pod['pod_node_name'] = json_data['spec']['nodeName']
-            except Exception as exc:
-                pod['pod_node_name'] = None
+            shard_nodes = [node for node in nodes if node is not None]
+            node_items = self.scrape(cluster, self.query_node_pods, shard_nodes)
+            if node_items is None or len(node_items) != len(shard_nodes):
+                raise ListError("Pods of some nodes were not listed")
 
-            pod['pod_metrics_endpoint'] = str(self.args['url']) + json_data['metadata']['selfLink'] + str('/proxy/metrics')
+            for items_of_node in node_items:
+                for item in items_of_node:
+                    items[item['metadata']['uid']] = item
 
-            pod['pod_metrics'] = self.query_metrics(pod['pod_metrics_endpoint'])
+            selector = " in (" + ",".join(sorted(CLUSTER_EXPORTERS)) + ")"
+            for label in KNOWN_EXPORTER_LABELS:
+                for item in self.query_scoped_list(cluster, "pods", label_selector=label + selector, deadline=cluster['deadline']):
+                    items[item['metadata']['uid']] = item
 
-            return pod
+            return list(items.values())
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_pod] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.query_pod_items] EXCEPTION: %s", "info", exc)
 
-            return
+            raise
 
-    def query_metrics(self, metrics_endpoint):
+    def query_node_pods(self, cluster, node):
         try:
-            self.log("[remotekubernetesplugin.query_metrics]", "info")
-
-            results = []
+            self.log_sampled("[remotekubernetesplugin.query_node_pods]", "info")
 
-            content = self.query_url(metrics_endpoint)
-            lines = content.split('\n')
+            return list(self.query_scoped_list(cluster, "pods", field_selector="spec.nodeName=" + node['node_name'],
+                                               deadline=cluster['deadline']))
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_node_pods] EXCEPTION: %s", "info", exc)
 
-            if not lines[0].startswith('#'):
-                return []
+            return
 
-            parsed_metrics = self.parse(lines)
+    def scrape_pods(self, cluster, pods, services):
+        try:
+            self.log("[remotekubernetesplugin.scrape_pods]", "info")
 
-            for parsed_metric in parsed_metrics:
-                for metric in self.args['metrics']:
-                    if parsed_metric['key'] == metric['key']:
-                        result = {}
+            service_targets = self.query_service_targets(cluster, services)
 
-                        result['entity'] = 'CUSTOM_DEVICE'
-                        result['key'] = metric['key']
-                        result['type'] = metric['type']
-                        result['relative'] = metric['relative']
+            for pod in pods:
+                pod['pod_metrics'] = None
 
-                        result['value'] = parsed_metric['value']
+                if pod['pod_metrics_endpoint'] is None:
+                    scrape = service_targets.get((pod['pod_namespace'], pod['pod_name']))
+                    if scrape is not None:
+                        pod['pod_metrics_endpoint'] = self.metrics_endpoint(cluster, pod['pod_self_link'], pod['pod_name'], scrape)
+                        pod['pod_direct_endpoint'] = self.direct_endpoint(pod['pod_ip'], scrape, pod['pod_metrics_port'])
 
-                        dimensions = {}
-                        for dimension in parsed_metric['dimensions']:
-                            dimensions[dimension['key']] = dimension['value']
+            self.scrape(cluster, self.query_pod_metrics, [pod for pod in pods if pod['pod_metrics_endpoint'] is not None])
 
-                        result['dimensions'] = dimensions
+            # Buckets of targets that went away are not kept forever
+            expired = time.time() - FAMILY_TTL
+            for endpoint, (scraped, _) in list(cluster['family_buckets'].items()):
+                if scraped < expired:
+                    cluster['family_buckets'].pop(endpoint, None)
 
-                        results.append(result)
+            return pods
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.scrape_pods] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def kubelet_targets(self, cluster, nodes):
+        try:
+            self.log("[remotekubernetesplugin.kubelet_targets]", "info")
+
+            targets = []
+
+            # The cAdvisor endpoint of every kubelet is scraped as a pod of its
+            # node, so its unlabelled samples are reported on that node
+            for node in nodes:
+                if node is None:
+                    continue
+
+                target = {}
+
+                target['pod_id'] = node['node_id'] + "/kubelet"
+                target['pod_name'] = "kubelet/" + node['node_name']
+                target['pod_namespace'] = None
+                target['pod_self_link'] = "/api/v1/nodes/" + node['node_name']
+                target['pod_node_name'] = node['node_name']
+                target['pod_ip'] = node.get('node_internal_ip')
+                target['pod_metrics_port'] = self.args['kubelet_port']
+                target['pod_kubelet'] = True
+                target['pod_metrics_endpoint'] = str(cluster['url']) + target['pod_self_link'] + "/proxy/metrics/cadvisor"
+                target['pod_direct_endpoint'] = self.direct_endpoint(target['pod_ip'], {'scheme': "https", 'port': None, 'path': "/metrics/cadvisor"},
+                                                                     target['pod_metrics_port'])
+
+                targets.append(target)
+
+            return targets
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_metrics] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.kubelet_targets] EXCEPTION: %s", "info", exc)
+
+            return []
+
+    def query_service_targets(self, cluster, services):
+        try:
+            self.log("[remotekubernetesplugin.query_service_targets]", "info")
+
+            targets = {}
+
+            if self.args['scrape_discovery'] != "true" or services is None:
+                return targets
+
+            # Pods behind a service annotated with prometheus.io/scrape are
+            # scraped with the port and path of the service annotations. The
+            # endpoints of all services come in one list, not one GET each.
+            annotated = {}
+            for service in services:
+                if service is None or service['service_scrape'] is None or service['service_namespace'] is None:
+                    continue
+
+                annotated[(service['service_namespace'], service['service_name'])] = service['service_scrape']
+
+            if not annotated:
+                return targets
+
+            for item in self.query_scoped_list(cluster, "endpoints"):
+                namespace = item['metadata'].get('namespace')
+                scrape = annotated.get((namespace, item['metadata'].get('name')))
+                if scrape is None:
+                    continue
+
+                for subset in item.get('subsets') or []:
+                    for address in subset.get('addresses') or []:
+                        target_ref = address.get('targetRef')
+                        if target_ref is not None and target_ref.get('kind') == "Pod":
+                            targets[(target_ref.get('namespace', namespace), target_ref['name'])] = scrape
+
+            return targets
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.query_service_targets] EXCEPTION: %s", "info", exc)
+
+            return {}
+
+    def scrape(self, cluster, func, items):
+        try:
+            self.log("[remotekubernetesplugin.scrape]", "info")
+
+            results = [None] * len(items)
+            pending = {}
+            index = 0
+
+            # Keep at most max_in_flight requests running against the cluster,
+            # topping the window up as requests complete until the poll deadline.
+            while index < len(items) or pending:
+                while index < len(items) and len(pending) < cluster['max_in_flight']:
+                    pending[self.submit(self.executor, func, cluster, items[index])] = index
+                    index = index + 1
+
+                remaining = cluster['deadline'] - time.time()
+                if remaining <= 0:
+                    break
+
+                done, not_done = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+
+            if pending:
+                self.log("[remotekubernetesplugin.scrape] DEADLINE EXCEEDED: %s of %s items dropped", "info", len(pending) + len(items) - index, len(items))
+
+                for future in pending:
+                    future.cancel()
+
+            return [result for result in results if result is not None]
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.scrape] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def query_pod(self, cluster, self_link):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_pod]", "info")
+
+            url = str(cluster['url']) + str(self_link)
+            content = self.query_url(cluster, url)
+            json_data = json.loads(content)
+
+            return self.build_pod(cluster, json_data)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_pod] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def build_pod(self, cluster, json_data):
+        try:
+            self.log_sampled("[remotekubernetesplugin.build_pod]", "info")
+
+            pod = {}
+
+            pod['pod_id'] = json_data['metadata']['uid']
+            pod['pod_name'] = json_data['metadata']['name']
+            pod['pod_namespace'] = json_data['metadata'].get('namespace')
+            pod['pod_self_link'] = self.self_link(json_data, "pods")
+
+            try:
+                pod['pod_node_name'] = json_data['spec']['nodeName']
+            except Exception as exc:
+                pod['pod_node_name'] = None
+
+            pod['pod_ip'] = (json_data.get('status') or {}).get('podIP')
+            pod['pod_metrics_port'] = self.metrics_port(json_data.get('spec'))
+            pod['pod_kubelet'] = False
+
+            pod['pod_cluster_exporter'] = self.is_known_exporter(json_data['metadata'].get('labels'), CLUSTER_EXPORTERS)
+
+            if self.args['scrape_discovery'] == "true":
+                scrape = self.scrape_config(json_data['metadata'].get('annotations'))
+
+                if scrape is None and self.is_known_exporter(json_data['metadata'].get('labels')):
+                    scrape = {'scheme': None, 'port': None, 'path': "/metrics"}
+            else:
+                scrape = {'scheme': None, 'port': None, 'path': "/metrics"}
+
+            if scrape is not None:
+                pod['pod_metrics_endpoint'] = self.metrics_endpoint(cluster, pod['pod_self_link'], pod['pod_name'], scrape)
+                pod['pod_direct_endpoint'] = self.direct_endpoint(pod['pod_ip'], scrape, pod['pod_metrics_port'])
+            else:
+                pod['pod_metrics_endpoint'] = None
+                pod['pod_direct_endpoint'] = None
+
+            return pod
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.build_pod] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def query_pod_metrics(self, cluster, pod):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_pod_metrics]", "info")
+
+            # Direct scrapes that fail fall back to the API server proxy, and
+            # stay on the proxy while the direct endpoint is backed off
+            if pod.get('pod_direct_endpoint') is not None:
+                headers = None if pod['pod_kubelet'] else DIRECT_SCRAPE_HEADERS
+
+                pod['pod_metrics'] = self.scrape_target(cluster, pod['pod_direct_endpoint'], headers)
+                if pod['pod_metrics'] is not None:
+                    return pod
+
+                cluster['stats'].count("proxy_fallbacks")
+
+            pod['pod_metrics'] = self.scrape_target(cluster, pod['pod_metrics_endpoint'])
+
+            return pod
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_pod_metrics] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def scrape_target(self, cluster, endpoint, headers=None):
+        try:
+            failure = cluster['scrape_failures'].get(endpoint)
+            if failure is not None and failure[1] > time.time():
+                return None
+
+            metrics = self.query_metrics(cluster, endpoint, headers)
+
+            # Targets that keep failing are parked with exponential backoff
+            # instead of burning request timeouts on every poll
+            if metrics is None:
+                failures = failure[0] + 1 if failure is not None else 1
+                backoff = min(SCRAPE_BACKOFF_BASE * 2 ** (failures - 1), SCRAPE_BACKOFF_MAX)
+                cluster['scrape_failures'][endpoint] = (failures, time.time() + backoff)
+            elif failure is not None:
+                cluster['scrape_failures'].pop(endpoint, None)
+
+            return metrics
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.scrape_target] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def scrape_config(self, annotations):
+        if not annotations or annotations.get('prometheus.io/scrape') != "true":
+            return None
+
+        return {'scheme': annotations.get('prometheus.io/scheme'),
+                'port': annotations.get('prometheus.io/port'),
+                'path': annotations.get('prometheus.io/path', "/metrics")}
+
+    def is_known_exporter(self, labels, exporters=KNOWN_EXPORTERS):
+        if not labels:
+            return False
+
+        for label in KNOWN_EXPORTER_LABELS:
+            if labels.get(label) in exporters:
+                return True
+
+        return False
+
+    def metrics_endpoint(self, cluster, self_link, name, scrape):
+        # Proxy path of a pod or service: [scheme:]name[:port]/proxy/path
+        target = name
+        if scrape['scheme'] == "https":
+            target = "https:" + target
+        if scrape['port']:
+            target = target + ":" + str(scrape['port'])
+
+        path = scrape['path'] if scrape['path'].startswith("/") else "/" + scrape['path']
+
+        return str(cluster['url']) + self_link[:len(self_link) - len(name)] + target + "/proxy" + path
+
+    def direct_endpoint(self, ip, scrape, port):
+        # URL of a target on its own address: pod IP or kubelet, None when
+        # direct scraping is off or the address or port is not known
+        if self.args['direct_scrape'] != "true" or not ip:
+            return None
+
+        port = scrape['port'] or port
+        if not port:
+            return None
+
+        host = "[" + ip + "]" if ":" in ip else ip
+        path = scrape['path'] if scrape['path'].startswith("/") else "/" + scrape['path']
+
+        return (scrape['scheme'] or "http") + "://" + host + ":" + str(port) + path
+
+    def metrics_port(self, spec):
+        # The container port named like a metrics port, otherwise the first
+        # declared one
+        ports = [port for container in (spec or {}).get('containers') or [] for port in container.get('ports') or []]
+
+        for port in ports:
+            if port.get('name') in METRICS_PORT_NAMES:
+                return port.get('containerPort')
+
+        return ports[0].get('containerPort') if ports else None
+
+    def self_link(self, json_data, resource):
+        # metadata.selfLink is no longer populated since Kubernetes 1.20, so
+        # rebuild the path from the object name and namespace when it is missing
+        if json_data['metadata'].get('selfLink'):
+            return json_data['metadata']['selfLink']
+
+        if 'namespace' in json_data['metadata']:
+            return "/api/v1/namespaces/" + json_data['metadata']['namespace'] + "/" + resource + "/" + json_data['metadata']['name']
+
+        return "/api/v1/" + resource + "/" + json_data['metadata']['name']
+
+    def query_metrics(self, cluster, metrics_endpoint, headers=None):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_metrics]", "info")
+
             results = []
 
+            stats = cluster['stats']
+
+            start_time = time.time()
+            content = self.query_url(cluster, metrics_endpoint, headers)
+            stats.add_time("scrape", time.time() - start_time)
+            if content is None:
+                return None
+
+            start_time = time.time()
+            lines = content.split('\n')
+
+            if not lines[0].startswith('#'):
+                return None
+
+            metric_index = self.args['metric_index']
+            families = self.args['families']
+            family_samples = []
+            types = {}
+            merged = {}
+            merges = 0
+
+            for sample in self.parse(lines, types, keys=self.args['metric_keys']):
+                if sample.key in families:
+                    family_samples.append(sample)
+                    continue
+
+                metric = metric_index.get(sample.key)
+                if metric is None:
+                    continue
+
+                sample.relative = metric['relative']
+
+                # Labels that are not dimensions of the metric in plugin.json
+                # are pruned and the samples they told apart are summed up.
+                # Samples that feed an aggregate are pruned but kept apart, as
+                # the aggregates count them.
+                labels = sample.labels
+                if labels:
+                    allowed = metric['dimension_set']
+                    kept = tuple([pair for pair in labels if pair[0] in allowed])
+
+                    if len(kept) != len(labels):
+                        sample.dimension_labels = kept
+
+                        if not metric['aggregate_source']:
+                            merge_key = (sample.key, kept, tuple([pair for pair in labels if pair[0] in ROUTING_LABELS]))
+                            merged_sample = merged.get(merge_key)
+                            if merged_sample is not None:
+                                merged_sample.value += sample.value
+                                merges = merges + 1
+                                continue
+                            merged[merge_key] = sample
+
+                results.append(sample)
+
+            if family_samples:
+                results.extend(self.summarize_families(cluster, metrics_endpoint, family_samples, types))
+
+            stats.add_time("parse", time.time() - start_time)
+            stats.count("lines_read", len(lines))
+            stats.count("samples_kept", len(results))
+            stats.count("samples_merged", merges)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.query_metrics] EXCEPTION: %s", "info", exc)
+            results = None
+
         return results
 
-    def query_url(self, url):
+    def summarize_families(self, cluster, metrics_endpoint, samples, types):
         try:
-            self.log("[remotekubernetesplugin.query_url]", "info")
-            self.log("[remotekubernetesplugin.query_url] URL: " + url, "info")
+            self.log_sampled("[remotekubernetesplugin.summarize_families]", "info")
 
-            content = None
+            results = []
+            families = self.args['families']
+            groups = {}
+
+            # Samples of a family are grouped by their labels apart from le
+            # and quantile, each group becoming one set of statistics
+            for sample in samples:
+                family, metric, count_metric = families[sample.key]
+                labels = tuple([pair for pair in sample.labels if pair[0] not in FAMILY_LABELS])
+
+                group = groups.get((family, labels))
+                if group is None:
+                    group = groups[(family, labels)] = {'metric': metric, 'count_metric': count_metric, 'buckets': [], 'quantiles': {},
+                                                        'sum': None, 'count': None}
+
+                suffix = sample.key[len(family):]
+                if suffix == "_sum":
+                    group['sum'] = sample.value
+                elif suffix == "_count":
+                    group['count'] = sample.value
+                else:
+                    for label, value in sample.labels:
+                        if label == "le":
+                            group['buckets'].append((float(value), sample.value))
+                        elif label == "quantile":
+                            group['quantiles'][float(value)] = sample.value
+
+            # Histograms are computed from the buckets of this interval, the
+            # difference to the cumulative buckets of the previous scrape. A
+            # count below the previous one means the target restarted and its
+            # buckets started over.
+            previous = cluster['family_buckets'].get(metrics_endpoint)
+            previous = previous[1] if previous is not None else {}
+            current = {}
+
+            for (family, labels), group in groups.items():
+                metric = group['metric']
+                buckets = sorted(group['buckets'])
+                current[(family, labels)] = (buckets, group['sum'], group['count'])
+                statistics = []
+
+                if types.get(family) == "summary" or (not buckets and group['quantiles']):
+                    for quantile, name in FAMILY_QUANTILES:
+                        value = group['quantiles'].get(quantile)
+                        if value is not None and value == value:
+                            statistics.append((name, value))
+
+                last = previous.get((family, labels))
+                if last is not None:
+                    last_buckets, last_sum, last_count = last
+                    reset = group['count'] is not None and last_count is not None and group['count'] < last_count
+
+                    if buckets:
+                        last_counts = dict(last_buckets)
+                        if not reset and any(count < last_counts.get(bound, 0.0) for bound, count in buckets):
+                            reset = True
+                        if not reset:
+                            buckets = [(bound, count - last_counts.get(bound, 0.0)) for bound, count in buckets]
+
+                        if buckets[-1][0] == float("inf"):
+                            for quantile, name in FAMILY_QUANTILES:
+                                value = bucket_quantile(quantile, buckets)
+                                if value is not None:
+                                    statistics.append((name, value))
+
+                    count_metric = group['count_metric']
+                    if count_metric is not None and group['count'] is not None and last_count is not None:
+                        kept = tuple([pair for pair in labels if pair[0] in count_metric['dimension_set']])
+                        results.append(Sample(count_metric['key'], tuple([pair for pair in labels if pair[0] in ROUTING_LABELS]),
+                                              float(group['count'] if reset else group['count'] - last_count), None, False, kept))
+                    if group['sum'] is not None and last_sum is not None:
+                        statistics.append(("sum", group['sum'] if reset else group['sum'] - last_sum))
+
+                # Only the routing labels are kept for finding the node, the
+                # other labels are reported when they are dimensions
+                routing = tuple([pair for pair in labels if pair[0] in ROUTING_LABELS])
+                kept = tuple([pair for pair in labels if pair[0] in metric['dimension_set']])
+                for name, value in statistics:
+                    results.append(Sample(metric['key'], routing, float(value), None, False, kept + (("statistic", name),)))
+
+            cluster['family_buckets'][metrics_endpoint] = (time.time(), current)
 
-            max_retries = 2
-            retries = 0
-            while retries < max_retries:
-                retries = retries + 1
-                try:
-                    r = requests.get(url, verify=False, headers={"Authorization": "Bearer " + self.args['token']}, timeout=2)
-                    content = r.content.decode('UTF-8')
+            return results
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.summarize_families] EXCEPTION: %s", "info", exc)
 
-                    self.log("[remotekubernetesplugin.query_url] RESPONSE: " + str(content), "info")
+            return []
 
-                    return content
-                except Exception as exc:
-                    self.log("[remotekubernetesplugin.query_url] EXCEPTION: " + str(exc), "info")
-                    continue
+    def create_session(self, cluster):
+        try:
+            self.log("[remotekubernetesplugin.create_session]", "info")
+
+            # One keep-alive session per cluster, so TCP and TLS handshakes are
+            # paid once per pooled connection instead of once per request
+            session = requests.Session()
+            session.verify = False
+            session.headers.update({"Authorization": "Bearer " + cluster['token'],
+                                    "Accept-Encoding": "gzip",
+                                    "Connection": "keep-alive"})
+
+            # The API server gets an adapter of its own, so direct scrapes of
+            # pod IPs and kubelets never evict its pool of connections
+            adapter = HTTPAdapter(pool_connections=DIRECT_SCRAPE_POOLS, pool_maxsize=2)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.mount(cluster['url'] + "/", HTTPAdapter(pool_connections=1, pool_maxsize=self.args['pool_size']))
+
+            return session
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.create_session] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def session_stats(self, cluster):
+        stats = {'pools': 0, 'requests': 0, 'connections': 0, 'reused': 0}
+
+        try:
+            for adapter in set(cluster['session'].adapters.values()):
+                pools = adapter.poolmanager.pools
+
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+
+                    stats['pools'] = stats['pools'] + 1
+                    stats['requests'] = stats['requests'] + pool.num_requests
+                    stats['connections'] = stats['connections'] + pool.num_connections
+
+            stats['reused'] = max(0, stats['requests'] - stats['connections'])
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.session_stats] EXCEPTION: %s", "info", exc)
+
+        return stats
+
+    def query_url(self, cluster, url, headers=None):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_url]", "info")
+            self.log_sampled("[remotekubernetesplugin.query_url] URL: %s", "info", url)
+
+            r = self.request(cluster, url, headers=headers)
+            if r is None:
+                return None
+
+            cluster['stats'].count("bytes", len(r.content))
+            content = r.content.decode('UTF-8')
+
+            self.log_sampled("[remotekubernetesplugin.query_url] RESPONSE: %.1024s", "info", content)
 
             return content
         except Exception as exc:
-            self.log("[remotekubernetesplugin.query_url] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.query_url] EXCEPTION: %s", "info", exc)
 
             return
 
-    def parse(self, lines):
+    def request(self, cluster, url, params=None, stream=False, read_timeout=None, passthrough=(), headers=None):
         try:
-            self.log("[remotekubernetesplugin.parse]", "info")
+            stats = cluster['stats']
+            circuit = self.circuit_key(url)
 
-            metrics = []
+            if not self.circuit_closed(cluster, circuit):
+                stats.count("circuit_open")
 
-            for line in lines:
-                if line.startswith("#") or line == '':
-                    continue
+                return None
 
-                metric = {'key': self.parse_key(line),
-                          'dimensions': self.parse_dimensions(line),
-                          'value': self.parse_value(line)}
+            timeout = (self.args['connect_timeout'], read_timeout if read_timeout is not None else self.args['read_timeout'])
 
-                metrics.append(metric)
+            attempt = 0
+            while True:
+                attempt = attempt + 1
+                if attempt > 1:
+                    stats.count("retries")
 
-            return metrics
+                delay = None
+                try:
+                    stats.count("requests")
+                    start_time = time.time()
+                    r = cluster['session'].get(url, params=params, stream=stream, timeout=timeout, headers=headers)
+                    if not stream:
+                        stats.add_latency(time.time() - start_time)
+
+                    if r.status_code < 400 or r.status_code in passthrough:
+                        self.circuit_success(cluster, circuit)
+
+                        return r
+
+                    r.close()
+                    stats.count("http_" + str(r.status_code // 100) + "xx")
+                    self.log_sampled("[remotekubernetesplugin.request] STATUS %s: %s", "info", r.status_code, url)
+
+                    # Authorization errors, missing objects and other client
+                    # errors would only fail again, so they are not retried
+                    # and do not count against the target either
+                    if r.status_code not in RETRY_STATUSES:
+                        return None
+
+                    self.circuit_failure(cluster, circuit)
+                    delay = self.retry_after(r)
+                except Exception as exc:
+                    stats.count("timeouts" if isinstance(exc, requests.exceptions.Timeout) else "errors")
+                    self.log_sampled("[remotekubernetesplugin.request] EXCEPTION: %s", "info", exc)
+                    self.circuit_failure(cluster, circuit)
+
+                if attempt > self.args['retries']:
+                    return None
+
+                # Full jitter around an exponential backoff, so concurrent
+                # workers retrying against the same server spread out
+                if delay is None:
+                    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+                if time.time() + delay >= cluster['deadline'] or not self.circuit_closed(cluster, circuit):
+                    return None
+
+                if self.stop_event.wait(delay):
+                    return None
         except Exception as exc:
-            self.log("[remotekubernetesplugin.parse] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.request] EXCEPTION: %s", "info", exc)
 
             return
 
-    def parse_key(self, line):
+    def retry_after(self, r):
+        # Only the delta-seconds form, an HTTP date falls back to the backoff
+        try:
+            return max(0.0, float(r.headers['Retry-After']))
+        except Exception:
+            return None
+
+    def circuit_key(self, url):
+        # Proxied pods and services are targets of their own, API calls are
+        # keyed by the resource they list, watch or get, so failing endpoints
+        # lookups do not hold back the pod list. Anything else is keyed by
+        # the host it is sent to.
+        position = url.find("/proxy")
+        if position != -1:
+            return url[:position]
+
+        parsed = urlparse(url)
+        key = parsed.scheme + "://" + parsed.netloc
+
+        segments = parsed.path.split("/")
+        if len(segments) > 3 and segments[1] == "api":
+            resources = segments[3:]
+            if resources[0] == "namespaces" and len(resources) > 2:
+                resources = resources[2:]
+
+            return key + "/api/" + segments[2] + "/" + resources[0]
+
+        return key
+
+    def circuit_closed(self, cluster, key):
+        circuit = cluster['circuits'].get(key)
+
+        return circuit is None or circuit['open_until'] <= time.time()
+
+    def circuit_failure(self, cluster, key):
+        with cluster['circuit_lock']:
+            circuit = cluster['circuits'].setdefault(key, {'failures': 0, 'open_until': 0})
+            circuit['failures'] = circuit['failures'] + 1
+
+            # Once open, a single failed trial after CIRCUIT_OPEN_SECONDS
+            # opens the circuit again
+            if circuit['failures'] >= CIRCUIT_FAILURES:
+                circuit['open_until'] = time.time() + CIRCUIT_OPEN_SECONDS
+                self.log_sampled("[remotekubernetesplugin.circuit_failure] CIRCUIT OPEN: %s", "info", key)
+
+    def circuit_success(self, cluster, key):
+        if key in cluster['circuits']:
+            with cluster['circuit_lock']:
+                cluster['circuits'].pop(key, None)
+
+    def start_watches(self, cluster):
         try:
-            self.log("[remotekubernetesplugin.parse_key]", "info")
+            builders = {'nodes': self.build_node, 'services': self.build_service, 'pods': self.build_pod}
+
+            for resource in builders:
+                for path in cluster['inventory'][resource]:
+                    thread = cluster['inventory'][resource][path]['thread']
+                    if thread is None or not thread.is_alive():
+                        thread = threading.Thread(target=self.watch, args=(cluster, resource, path, builders[resource]),
+                                                  name="remotekubernetesplugin-watch-" + cluster['id'] + path, daemon=True)
+                        thread.start()
+                        cluster['inventory'][resource][path]['thread'] = thread
 
-            return str(line.split(' ')[0].split('{')[0])
+            return
         except Exception as exc:
-            self.log("[remotekubernetesplugin.parse_key] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.start_watches] EXCEPTION: %s", "info", exc)
 
             return
 
-    def parse_value(self, line):
+    def watch(self, cluster, resource, path, build):
+        inventory = cluster['inventory'][resource][path]
+
+        while not self.stop_event.is_set():
+            try:
+                if inventory['resource_version'] is None:
+                    self.relist(cluster, resource, path, build)
+
+                    if inventory['resource_version'] is None:
+                        self.stop_event.wait(10)
+                        continue
+
+                self.log("[remotekubernetesplugin.watch] WATCH %s FROM %s", "info", path, inventory['resource_version'])
+
+                params = dict(self.list_selectors(resource), watch="true", allowWatchBookmarks="true", timeoutSeconds=300,
+                              resourceVersion=inventory['resource_version'])
+                r = self.query_stream(cluster, str(cluster['url']) + path, params, read_timeout=330)
+                if r is None:
+                    self.stop_event.wait(10)
+                    continue
+
+                try:
+                    if r.status_code == 410:
+                        inventory['resource_version'] = None
+                        continue
+
+                    for line in r.iter_lines():
+                        if self.stop_event.is_set():
+                            break
+                        if not line:
+                            continue
+
+                        event = json.loads(line)
+                        obj = event['object']
+
+                        # 410 Gone: the resourceVersion has been compacted away,
+                        # so the inventory has to be rebuilt from a fresh list
+                        if event['type'] == "ERROR":
+                            if obj.get('code') == 410:
+                                inventory['resource_version'] = None
+                            break
+
+                        if event['type'] in ("ADDED", "MODIFIED"):
+                            item = build(cluster, obj)
+                            if item is not None:
+                                with inventory['lock']:
+                                    inventory['items'][obj['metadata']['uid']] = item
+                        elif event['type'] == "DELETED":
+                            with inventory['lock']:
+                                inventory['items'].pop(obj['metadata']['uid'], None)
+
+                        inventory['resource_version'] = obj['metadata']['resourceVersion']
+                        inventory['events'] = inventory['events'] + 1
+                        inventory['last_event'] = time.time()
+                finally:
+                    r.close()
+            except Exception as exc:
+                self.log("[remotekubernetesplugin.watch] EXCEPTION: %s", "info", exc)
+                self.stop_event.wait(10)
+
+    def relist(self, cluster, resource, path, build):
         try:
-            self.log("[remotekubernetesplugin.parse_value]", "info")
+            self.log("[remotekubernetesplugin.relist] RELIST %s", "info", path)
+
+            inventory = cluster['inventory'][resource][path]
+            metadata = {}
+            items = {}
+
+            for obj in self.query_list(cluster, path, metadata, self.list_selectors(resource)):
+                item = build(cluster, obj)
+                if item is not None:
+                    items[obj['metadata']['uid']] = item
 
-            return str(line.split(' ')[1])
+            # A list that was started over mixes two versions of the cluster,
+            # watching from the later one could miss changes to the earlier
+            if 'resourceVersion' not in metadata or metadata.get('restarted'):
+                return
+
+            with inventory['lock']:
+                inventory['items'] = items
+
+            inventory['resource_version'] = metadata['resourceVersion']
+            inventory['relists'] = inventory['relists'] + 1
+            inventory['last_sync'] = time.time()
+            inventory['synced'] = True
+
+            return
         except Exception as exc:
-            self.log("[remotekubernetesplugin.parse_value] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.relist] EXCEPTION: %s", "info", exc)
 
             return
 
-    def parse_dimensions(self, line):
+    def read_inventory(self, cluster, resource):
+        items = []
+
+        for inventory in cluster['inventory'][resource].values():
+            with inventory['lock']:
+                items.extend(inventory['items'].values())
+
+        return items
+
+    def inventory_synced(self, cluster, resource):
+        # Served from the watches only once every included namespace has
+        # been listed, a partial inventory would drop whole namespaces
+        return all(inventory['synced'] for inventory in cluster['inventory'][resource].values())
+
+    def inventory_stats(self, cluster):
+        stats = {}
+        now = time.time()
+
+        for resource in cluster['inventory']:
+            for path, inventory in cluster['inventory'][resource].items():
+                last_update = max(inventory['last_sync'], inventory['last_event'])
+
+                stats[path] = {'synced': inventory['synced'],
+                               'items': len(inventory['items']),
+                               'relists': inventory['relists'],
+                               'events': inventory['events'],
+                               'seconds_since_relist': now - inventory['last_sync'] if inventory['last_sync'] else None,
+                               'seconds_since_update': now - last_update if last_update else None}
+
+        return stats
+
+    def query_list(self, cluster, path, metadata=None, params=None, deadline=None):
         try:
-            self.log("[remotekubernetesplugin.parse_dimensions]", "info")
+            self.log("[remotekubernetesplugin.query_list]", "info")
+            self.log("[remotekubernetesplugin.query_list] PATH: %s", "info", path)
+
+            if metadata is None:
+                metadata = {}
+
+            url = str(cluster['url']) + path
+            params = dict(params or {}, limit=self.args['page_size'])
+            stats = cluster['stats']
+            seen = set()
+            restarts = 0
+
+            def count_bytes(chunks):
+                for chunk in chunks:
+                    stats.count("bytes", len(chunk))
+                    yield chunk
+
+            # Walk the list in limit/continue pages and decode each page item by
+            # item, so memory is bounded by the page size rather than the cluster.
+            # Time spent by the caller on the yielded items is not counted.
+            # A list that fails, ends early or runs past the deadline raises
+            # ListError, so callers never take part of a list for all of it.
+            while True:
+                if deadline is not None and time.time() >= deadline:
+                    raise ListError("List of " + path + " overran the deadline")
+
+                start_time = time.time()
+                r = self.query_stream(cluster, url, params)
+                if r is None:
+                    raise ListError("List of " + path + " failed")
+
+                # 410 Gone: the continue token expired, the list is started
+                # over and the objects that were already yielded are skipped
+                if r.status_code == 410:
+                    r.close()
+                    restarts = restarts + 1
+                    if 'continue' not in params or restarts > LIST_RESTARTS:
+                        raise ListError("List of " + path + " expired")
+
+                    stats.count("list_restarts")
+                    del params['continue']
+                    metadata.clear()
+                    metadata['restarted'] = True
+                    continue
+
+                try:
+                    for item in self.iter_list_items(count_bytes(r.iter_content(chunk_size=65536)), metadata):
+                        uid = item.get('metadata', {}).get('uid')
+                        if uid is not None:
+                            if uid in seen:
+                                continue
+                            seen.add(uid)
+
+                        if deadline is not None and time.time() >= deadline:
+                            raise ListError("List of " + path + " overran the deadline")
+
+                        stats.add_time("list", time.time() - start_time)
+                        yield item
+                        start_time = time.time()
+                finally:
+                    stats.add_time("list", time.time() - start_time)
+                    r.close()
+
+                if not metadata.get('continue'):
+                    return
+
+                params['continue'] = metadata.pop('continue')
+        except ListError as exc:
+            cluster['stats'].count("list_failures")
+            self.log("[remotekubernetesplugin.query_list] EXCEPTION: %s", "info", exc)
+
+            raise
+        except Exception as exc:
+            cluster['stats'].count("list_failures")
+            self.log("[remotekubernetesplugin.query_list] EXCEPTION: %s", "info", exc)
 
-            dimensions = []
+            raise ListError("List of " + path + " is incomplete: " + str(exc))
+
+    def query_scoped_list(self, cluster, resource, field_selector=None, label_selector=None, deadline=None):
+        try:
+            self.log("[remotekubernetesplugin.query_scoped_list] RESOURCE: %s", "info", resource)
+
+            params = self.list_selectors(resource, field_selector, label_selector)
+
+            for path in self.list_paths(resource):
+                for item in self.query_list(cluster, path, params=params, deadline=deadline):
+                    yield item
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.query_scoped_list] EXCEPTION: %s", "info", exc)
 
-            if len(line.split(' ')[0].split('{')) >= 2:
-                dims_temp = str(str(line.split(' ')[0].split('{')[1])).replace('{', '').replace('}', '').replace('"', '').split(',')
+            raise
 
-                for dim_temp in dims_temp:
-                    if len(dim_temp.split('=')) >= 2:
-                        dim_key = dim_temp.split('=')[0]
-                        dim_value = dim_temp.split('=')[1]
+    def list_paths(self, resource):
+        # Included namespaces are listed and watched one by one, so objects
+        # of any other namespace are never sent by the API server
+        if resource != "nodes" and self.args['namespaces']:
+            return ["/api/v1/namespaces/" + namespace + "/" + resource for namespace in self.args['namespaces']]
 
-                        dimension = {}
-                        dimension['key'] = dim_key
-                        dimension['value'] = dim_value
+        return ["/api/v1/" + resource]
 
-                        dimensions.append(dimension)
+    def list_selectors(self, resource, field_selector=None, label_selector=None):
+        # Field and label selectors of the lists and watches of a resource:
+        # the configured pod or service selectors and excluded namespaces,
+        # ANDed with the ones of the caller
+        fields = [field_selector] if field_selector else []
+        labels = [label_selector] if label_selector else []
 
-            return dimensions
+        if resource in ("pods", "services"):
+            prefix = resource[:-1]
+            if self.args[prefix + '_field_selector']:
+                fields.append(self.args[prefix + '_field_selector'])
+            if self.args[prefix + '_label_selector']:
+                labels.append(self.args[prefix + '_label_selector'])
+
+        if resource != "nodes" and not self.args['namespaces']:
+            fields.extend("metadata.namespace!=" + namespace for namespace in self.args['exclude_namespaces'])
+
+        params = {}
+        if fields:
+            params['fieldSelector'] = ",".join(fields)
+        if labels:
+            params['labelSelector'] = ",".join(labels)
+
+        return params
+
+    def query_stream(self, cluster, url, params, read_timeout=None):
+        try:
+            self.log_sampled("[remotekubernetesplugin.query_stream]", "info")
+            self.log_sampled("[remotekubernetesplugin.query_stream] URL: %s PARAMS: %s", "info", url, params)
+
+            # 410 Gone is handed to the watch, which relists on it
+            return self.request(cluster, url, params=params, stream=True, read_timeout=read_timeout, passthrough=(410,))
         except Exception as exc:
-            self.log("[remotekubernetesplugin.parse_dimensions] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.query_stream] EXCEPTION: %s", "info", exc)
 
             return
 
-    def report_topology(self, data):
+    def iter_list_items(self, chunks, metadata):
+        # Incremental decoder for a Kubernetes list object. Top-level members
+        # other than 'items' are collected into metadata, every element of
+        # 'items' is yielded as soon as it has been received completely.
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+        buffer = ""
+        position = 0
+        state = "start"
+        key = None
+
+        for chunk in chunks:
+            buffer = buffer[position:] + text_decoder.decode(chunk)
+            position = 0
+
+            while True:
+                position = JSON_WHITESPACE.match(buffer, position).end()
+                if position >= len(buffer):
+                    break
+
+                char = buffer[position]
+
+                if state == "start":
+                    if char != '{':
+                        raise ValueError("Expected list object at position " + str(position))
+                    position = position + 1
+                    state = "key"
+                elif state == "key":
+                    if char == ',':
+                        position = position + 1
+                        continue
+                    if char == '}':
+                        position = position + 1
+                        state = "end"
+                        continue
+                    try:
+                        key, position = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        break
+                    state = "colon"
+                elif state == "colon":
+                    if char != ':':
+                        raise ValueError("Expected ':' at position " + str(position))
+                    position = position + 1
+                    state = "items" if key == 'items' else "value"
+                elif state == "items" and char == '[':
+                    position = position + 1
+                    state = "item"
+                elif state == "item" and char in ',]':
+                    position = position + 1
+                    if char == ']':
+                        state = "key"
+                elif state == "end":
+                    raise ValueError("Unexpected data after list object at position " + str(position))
+                else:
+                    try:
+                        value, end = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        break
+
+                    # A number at the very end of the buffer may continue in
+                    # the next chunk, so wait for a delimiter before using it
+                    if end >= len(buffer) and char in '-0123456789':
+                        break
+
+                    position = end
+
+                    if state == "item":
+                        yield value
+                    elif key == 'metadata' and isinstance(value, dict):
+                        metadata.update(value)
+                        state = "key"
+                    else:
+                        state = "key"
+
+        if state != "end":
+            raise ValueError("Truncated list response")
+
+    def parse(self, lines, types=None, keys=None):
+        try:
+            self.log_sampled("[remotekubernetesplugin.parse]", "info")
+
+            return parse_exposition(lines, types, keys)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.parse] EXCEPTION: %s", "info", exc)
+
+            return iter(())
+
+    def report_topology(self, cluster, data):
         try:
             self.log("[remotekubernetesplugin.report_topology]", "info")
 
+            start_time = time.time()
+
+            # Forget the fingerprints of nodes that left the cluster
+            node_ids = set(node['node_id'] for node in data['nodes'])
+            for node_id in list(cluster['node_fingerprints']):
+                if node_id not in node_ids:
+                    del cluster['node_fingerprints'][node_id]
+
             group = self.report_topology_group(data['cluster']['cluster_id'], data['cluster']['cluster_name'])
 
             reported_group_metrics = []
 
-            for node in data["nodes"]:
+            pods = data['pods'] if data['pods'] is not None else []
+            route_time = time.time()
+            pod_nodes = self.index_pod_nodes(pods)
+            node_metrics = self.group_metrics_by_node(cluster, pods, pod_nodes)
+            cluster['stats'].add_time("route", time.time() - route_time)
+
+            node_samples = [[metric for pod_metrics in node_metrics(node['node_name']) for metric in pod_metrics] for node in data['nodes']]
+            deltas = iter(self.counter_deltas(cluster, data['nodes'], node_samples))
+
+            for node, samples in zip(data['nodes'], node_samples):
                 element = self.report_topology_element(group, node['node_id'], node['node_name'] + str(" (") + str(node['node_role']) + str(")"), node['node_external_ip'])
 
                 if self.args['dev'] == "false":
                     self.log("[remotekubernetesplugin.report_topology] Reporting properties", "info")
 
-                    element.report_property('node_instance_type', node['node_instance_type'])
-                    element.report_property('node_hostname', node['node_hostname'])
-                    element.report_property('node_creation_timestamp', node['node_creation_timestamp'])
-                    element.report_property('node_info_machine_id', node['node_info_machine_id'])
-                    element.report_property('node_info_system_uuid', node['node_info_system_uuid'])
-                    element.report_property('node_info_boot_id', node['node_info_boot_id'])
-                    element.report_property('node_info_kernel_version', node['node_info_kernel_version'])
-                    element.report_property('node_info_os_image', node['node_info_os_image'])
-                    element.report_property('node_info_container_runtime_version', node['node_info_container_runtime_version'])
-                    element.report_property('node_info_kubelet_version', node['node_info_kubelet_version'])
-                    element.report_property('node_info_kube_proxy_version', node['node_info_kube_proxy_version'])
-                    element.report_property('node_info_operating_system', node['node_info_operating_system'])
-                    element.report_property('node_info_architecture', node['node_info_architecture'])
+                    if self.node_properties_changed(cluster, node):
+                        for name in NODE_PROPERTIES:
+                            element.report_property(name, node[name])
+
+                for metric in samples:
+                    if not metric.reported:
+                        continue
+
+                    if metric.relative:
+                        delta = next(deltas)
+                        if delta is not None:
+                            self.report_topology_metric(element, metric, delta)
+                    else:
+                        self.report_topology_metric(element, metric)
 
-                if data["pods"] is not None:
-                    for pod in data["pods"]:
-                        reported_element_metrics = []
+                self.report_topology_custom_element_metrics(element, samples)
+                reported_group_metrics.extend(samples)
 
-                        if pod['pod_metrics'] is not None:
-                            for metric in pod['pod_metrics']:
-                                if self.is_reportable(data, metric, node['node_name'], pod['pod_name']):
-                                    self.report_topology_metric(element, metric)
-                                    reported_element_metrics.append(metric)
-                                    reported_group_metrics.append(metric)
+            # Deployment metrics are reported on every node, count them once
+            unique_group_metrics = list(dict((id(metric), metric) for metric in reported_group_metrics).values())
 
-                            self.report_topology_custom_element_metrics(element, reported_element_metrics)
+            cluster['stats'].add_time("report", time.time() - start_time)
+            cluster['stats'].count("samples_reported", sum(1 for metric in unique_group_metrics if metric.reported))
 
-            self.report_topology_custom_group_metrics(group, reported_group_metrics)
+            for metric in cluster['stats'].samples(self.args['shard_index']):
+                self.report_topology_metric(group, metric)
+
+            # Every shard only reports the nodes it owns, the group metrics are
+            # left to shard 0. As every shard scrapes the cluster exporters,
+            # shard 0 adds their samples of pods on other shards' nodes.
+            if self.args['shard_index'] != 0:
+                return
+
+            if self.args['shard_count'] > 1:
+                group_metrics = dict((id(metric), metric) for metric in unique_group_metrics)
+                for pod in pods:
+                    if pod.get('pod_cluster_exporter') and pod['pod_metrics'] is not None:
+                        group_metrics.update((id(metric), metric) for metric in pod['pod_metrics'])
+                unique_group_metrics = list(group_metrics.values())
+
+            self.report_topology_custom_group_metrics(group, unique_group_metrics)
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.report_topology] EXCEPTION: %s", "info", exc)
 
             return
 
+    def counter_deltas(self, cluster, nodes, node_samples):
+        try:
+            start_time = time.time()
+
+            # Relative series are told apart by the element they are reported
+            # on, as deployment metrics are reported on every node
+            series = []
+            values = []
+            for node, samples in zip(nodes, node_samples):
+                node_id = node['node_id']
+                for metric in samples:
+                    if metric.relative and metric.reported:
+                        series.append((node_id, metric.key, metric.labels if metric.dimension_labels is None else metric.dimension_labels))
+                        values.append(metric.value)
+
+            counters = cluster['counters']
+            deltas = counters.deltas(series, values, start_time)
+
+            cluster['stats'].add_time("deltas", time.time() - start_time)
+            cluster['stats'].count("counter_series", len(counters))
+
+            return deltas
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.counter_deltas] EXCEPTION: %s", "info", exc)
+
+            return [None] * sum(1 for samples in node_samples for metric in samples if metric.relative and metric.reported)
+
+    def node_properties_changed(self, cluster, node):
+        try:
+            now = time.time()
+            fingerprint = cluster['node_fingerprints'].get(node['node_id'])
+
+            # An unchanged resourceVersion is enough to skip a node, a changed
+            # one only counts if one of the reported properties changed too,
+            # as node status updates bump the version every few minutes
+            if fingerprint is not None and now - fingerprint[2] < self.args['property_resync_interval']:
+                if fingerprint[0] == node['node_resource_version']:
+                    return False
+
+                properties = tuple(node[name] for name in NODE_PROPERTIES)
+                if fingerprint[1] == properties:
+                    cluster['node_fingerprints'][node['node_id']] = (node['node_resource_version'], properties, fingerprint[2])
+
+                    return False
+            else:
+                properties = tuple(node[name] for name in NODE_PROPERTIES)
+
+            cluster['node_fingerprints'][node['node_id']] = (node['node_resource_version'], properties, now)
+
+            return True
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.node_properties_changed] EXCEPTION: %s", "info", exc)
+
+            return True
+
     def report_topology_group(self, id, name):
         try:
             self.log("[remotekubernetesplugin.report_topology_group]", "info")
             self.log("[remotekubernetesplugin.report_topology_group] Create topology group", "info")
-            self.log("[remotekubernetesplugin.report_topology_group] Create topology group: ID=" + str(id), "info")
-            self.log("[remotekubernetesplugin.report_topology_group] Create topology group: NAME=" + str(name), "info")
+            self.log("[remotekubernetesplugin.report_topology_group] Create topology group: ID=%s", "info", id)
+            self.log("[remotekubernetesplugin.report_topology_group] Create topology group: NAME=%s", "info", name)
 
             if self.args['dev'] == "false":
                 topology_group = self.topology_builder.create_group(id, name)
 
                 return topology_group
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology_group] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.report_topology_group] EXCEPTION: %s", "info", exc)
 
             return
 
     def report_topology_element(self, group, id, name, external_ip):
         try:
-            self.log("[remotekubernetesplugin.report_topology_element]", "info")
-            self.log("[remotekubernetesplugin.report_topology_element] Create topology +-- element", "info")
-            self.log("[remotekubernetesplugin.report_topology_element] Create topology +-- element: GROUP=" + str(group), "info")
-            self.log("[remotekubernetesplugin.report_topology_element] Create topology +-- element: ID=" + str(id), "info")
-            self.log("[remotekubernetesplugin.report_topology_element] Create topology +-- element: NAME=" + str(name), "info")
-            self.log("[remotekubernetesplugin.report_topology_element] Create topology +-- element: EXTERNAL_IP=" + str(external_ip), "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_element]", "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] Create topology +-- element", "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] Create topology +-- element: GROUP=%s", "info", group)
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] Create topology +-- element: ID=%s", "info", id)
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] Create topology +-- element: NAME=%s", "info", name)
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] Create topology +-- element: EXTERNAL_IP=%s", "info", external_ip)
 
             if self.args['dev'] == "false":
                 topology_element = group.create_element(id, name)
@@ -519,128 +2358,348 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
 
                 return topology_element
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology_element] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_element] EXCEPTION: %s", "info", exc)
 
             return
 
-    def report_topology_metrics(self, element, metrics):
+    def report_topology_metric(self, element, metric, delta=None):
         try:
-            self.log("[remotekubernetesplugin.report_topology_metrics]", "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_metric]", "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_metric] Create topology +---- metric: %s", "info", metric)
 
-            for metric in metrics:
-                self.report_topology_metric(element, metric)
+            if self.args['dev'] == "false":
+                # Relative metrics come with the delta to their previous value
+                if delta is not None:
+                    element.absolute(key=metric.key, value=delta, dimensions=metric.dimensions)
+                elif metric.relative:
+                    element.relative(key=metric.key, value=metric.value, dimensions=metric.dimensions)
+                else:
+                    element.absolute(key=metric.key, value=metric.value, dimensions=metric.dimensions)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.report_topology_metric] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def index_pod_nodes(self, pods):
+        try:
+            self.log("[remotekubernetesplugin.index_pod_nodes]", "info")
 
+            pod_nodes = defaultdict(set)
+
+            for pod in pods:
+                pod_nodes[pod['pod_name']].add(pod['pod_node_name'])
+
+            return pod_nodes
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology_metrics] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.index_pod_nodes] EXCEPTION: %s", "info", exc)
 
-            exit(-1)
+            return defaultdict(set)
 
-    def report_topology_metric(self, element, metric):
+    def group_metrics_by_node(self, cluster, pods, pod_nodes):
         try:
-            self.log("[remotekubernetesplugin.report_topology_metric]", "info")
-            self.log("[remotekubernetesplugin.report_topology_metric] Create topology +---- metric: " + " " + str(metric), "info")
+            self.log("[remotekubernetesplugin.group_metrics_by_node]", "info")
 
-            if self.args['dev'] == "false":
-                if metric['relative']:
-                    element.relative(key=metric['key'], value=metric['value'], dimensions=metric['dimensions'])
+            # One pass over all samples: each one is assigned to the nodes it is
+            # reported on, keeping the samples of every scraped pod together
+            owned = defaultdict(lambda: defaultdict(list))
+            shared = defaultdict(list)
+
+            # At most max_series distinct dimension sets per metric and poll are
+            # reported; samples over the cap are still routed for the aggregates
+            max_series = self.args['max_series']
+            series = defaultdict(set)
+            dropped = 0
+
+            for position, pod in enumerate(pods):
+                if pod['pod_metrics'] is None:
+                    continue
+
+                for metric in pod['pod_metrics']:
+                    if max_series:
+                        dimension_labels = metric.labels if metric.dimension_labels is None else metric.dimension_labels
+                        known = series[metric.key]
+                        metric.reported = dimension_labels in known or len(known) < max_series
+                        if not metric.reported:
+                            dropped = dropped + 1
+                        else:
+                            known.add(dimension_labels)
+
+                    nodes = self.metric_nodes(pod_nodes, metric, pod['pod_name'])
+
+                    if nodes is None:
+                        shared[position].append(metric)
+                    else:
+                        for node_name in nodes:
+                            owned[node_name][position].append(metric)
+
+            if dropped:
+                cluster['stats'].count("series_dropped", dropped)
+                self.log("[remotekubernetesplugin.group_metrics_by_node] MAX_SERIES EXCEEDED: %s samples not reported", "info", dropped)
+
+            def node_metrics(node_name):
+                metrics = owned.get(node_name, {})
+
+                for position in sorted(set(metrics) | set(shared)):
+                    yield metrics.get(position, []) + shared.get(position, [])
+
+            return node_metrics
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.group_metrics_by_node] EXCEPTION: %s", "info", exc)
+
+            return lambda node_name: iter(())
+
+    def metric_nodes(self, pod_nodes, metric, reporting_pod_name):
+        # Names of the nodes a metric belongs to, None if it belongs to all
+        # of them: deployment metrics are reported on every node, pod metrics
+        # on the node of that pod and unlabelled metrics on the node of the
+        # pod that exposed them.
+        if len(metric.labels) > 0:
+            pod_name = None
+
+            for label, value in metric.labels:
+                if label == 'deployment':
+                    return None
+                if label == 'pod':
+                    pod_name = value
+
+            if pod_name is not None:
+                return pod_nodes.get(pod_name, ())
+
+            return ()
+
+        return pod_nodes.get(reporting_pod_name, ())
+
+    def aggregate(self, metrics, scope):
+        try:
+            self.log_sampled("[remotekubernetesplugin.aggregate]", "info")
+
+            aggregates = self.args['aggregates'][scope]
+            totals = {}
+
+            # Single pass: every sample updates all derived metrics built on it
+            for metric in metrics:
+                derived_metrics = aggregates.get(metric.key)
+                if derived_metrics is None:
+                    continue
+
+                for derived_metric in derived_metrics:
+                    total = totals.get(derived_metric['key'])
+                    if total is None:
+                        total = totals[derived_metric['key']] = [0, 0, 0.0]
+
+                    definition = derived_metric['aggregate']
+
+                    total[0] = total[0] + 1
+                    if 'value' in definition and metric.value != definition['value']:
+                        continue
+                    if 'not_value' in definition and metric.value == definition['not_value']:
+                        continue
+
+                    total[1] = total[1] + 1
+                    total[2] = total[2] + metric.value
+
+            results = []
+
+            for derived_metric in self.args['aggregates']['order'][scope]:
+                total = totals.get(derived_metric['key'])
+                if total is None:
+                    continue
+
+                function = derived_metric['aggregate']['function']
+                if function == "count":
+                    value = total[1]
+                elif function == "sum":
+                    value = total[2]
+                elif function == "percent":
+                    value = 100.0 * total[1] / total[0]
                 else:
-                    element.absolute(key=metric['key'], value=metric['value'], dimensions=metric['dimensions'])
+                    continue
+
+                results.append(Sample(derived_metric['key'], (), value))
+
+            return results
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology_metric] EXCEPTION: " + str(exc), "info")
+            self.log_sampled("[remotekubernetesplugin.aggregate] EXCEPTION: %s", "info", exc)
 
-            return
+            return []
 
-    def is_reportable(self, data, metric, reporting_node_name, reporting_pod_name):
+    def report_topology_custom_element_metrics(self, element, metrics):
         try:
-            self.log("[remotekubernetesplugin.is_reportable]", "info")
+            self.log_sampled("[remotekubernetesplugin.report_topology_custom_element_metrics]", "info")
 
-            if len(metric['dimensions']) > 0:
-                for dimension in metric['dimensions']:
-                    if dimension == 'pod':
-                        pod_name = metric['dimensions'][dimension]
-                        for pod in data['pods']:
-                            if pod['pod_name'] == pod_name:
-                                if pod['pod_node_name'] == reporting_node_name:
-                                    return True
+            for metric in self.aggregate(metrics, "element"):
+                self.report_topology_metric(element, metric)
+        except Exception as exc:
+            self.log_sampled("[remotekubernetesplugin.report_topology_custom_element_metrics] EXCEPTION: %s", "info", exc)
 
-                    if dimension == 'deployment':
-                        return True
-            else:
-                for pod in data['pods']:
-                    if pod['pod_name'] == reporting_pod_name:
-                        if pod['pod_node_name'] == reporting_node_name:
-                            return True
+            return
 
-            return False
+    def report_topology_custom_group_metrics(self, group, metrics):
+        try:
+            self.log("[remotekubernetesplugin.report_topology_custom_group_metrics]", "info")
+
+            for metric in self.aggregate(metrics, "group"):
+                self.report_topology_metric(group, metric)
         except Exception as exc:
-            self.log("[remotekubernetesplugin.is_reportable] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.report_topology_custom_group_metrics] EXCEPTION: %s", "info", exc)
 
             return
 
-    def exists_metric(self, metrics, key):
+    def submit(self, executor, func, *args):
+        # From Python 3.12 on only one profiler can be active per process and
+        # it sees every thread, so the profile of the poll covers the tasks
+        if self.args['profile_file'] and sys.version_info < (3, 12):
+            return executor.submit(self.run_profiled, func, *args)
+
+        return executor.submit(func, *args)
+
+    def run_profiled(self, func, *args):
+        # cProfile only sees the thread it was enabled in, so every task on
+        # the worker pools gets its own profile, merged once the poll is done
+        profile = cProfile.Profile()
         try:
-            self.log("[remotekubernetesplugin.exists_metric]", "info")
+            profile.enable()
+        except ValueError:
+            return func(*args)
 
-            for metric in metrics:
-                if metric['key'] == key:
-                    return True
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            with self.profile_lock:
+                self.profiles.append(profile)
 
-            return False
+    def write_profile(self, profile):
+        try:
+            with self.profile_lock:
+                profiles = self.profiles
+                self.profiles = []
+
+            stats = pstats.Stats(profile)
+            for task_profile in profiles:
+                stats.add(task_profile)
+
+            stats.dump_stats(self.args['profile_file'])
         except Exception as exc:
-            self.log("[remotekubernetesplugin.exists_metric] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.write_profile] EXCEPTION: %s", "info", exc)
 
             return
 
-    def report_topology_custom_element_metrics(self, element, metrics):
+    def write_stats(self):
         try:
-            self.log("[remotekubernetesplugin.report_topology_custom_element_metrics]", "info")
+            stats = {}
+            for cluster in self.args['clusters']:
+                stats[cluster['id']] = cluster['stats'].as_dict()
+
+            # Written next to the target and renamed, so readers never see a
+            # partially written file
+            path = self.args['stats_file']
+            with open(path + ".tmp", "w") as stats_file:
+                json.dump({'time': time.time(), 'clusters': stats}, stats_file, indent=2, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.write_stats] EXCEPTION: %s", "info", exc)
 
-            if self.exists_metric(metrics, "kube_pod_container_status_ready"):
-                custom_pods_ready = {'entity': 'CUSTOM_DEVICE', 'key': "custom_pods_ready", 'type': "KubernetesStats", 'relative': False, 'dimensions': {}, 'value': 0}
-                custom_pods_not_ready = {'entity': 'CUSTOM_DEVICE', 'key': "custom_pods_not_ready", 'type': "KubernetesStats", 'relative': False, 'dimensions': {}, 'value': 0}
-                custom_pods_total = {'entity': 'CUSTOM_DEVICE', 'key': "custom_pods_total", 'type': "KubernetesStats", 'relative': False, 'dimensions': {}, 'value': 0}
+            return
 
-                for metric in metrics:
-                    if metric['key'] == "kube_pod_container_status_ready":
-                        custom_pods_total['value'] = int(custom_pods_total['value']) + 1
-                        if int(metric['value']) == 1:
-                            custom_pods_ready['value'] = int(custom_pods_ready['value']) + 1
-                        else:
-                            custom_pods_not_ready['value'] = int(custom_pods_not_ready['value']) + 1
+    def load_snapshot(self):
+        try:
+            path = self.args['snapshot_file']
+            if not os.path.exists(path):
+                return
 
-                self.report_topology_metric(element, custom_pods_ready)
-                self.report_topology_metric(element, custom_pods_not_ready)
-                self.report_topology_metric(element, custom_pods_total)
+            with open(path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
 
-            if self.exists_metric(metrics, "kube_pod_container_status_ready"):
-                custom_deployments_available = {'entity': 'CUSTOM_DEVICE', 'key': "custom_deployments_available", 'type': "KubernetesStats", 'relative': False, 'dimensions': {}, 'value': 0}
+            if snapshot.get('version') != SNAPSHOT_VERSION or time.time() - snapshot['time'] > SNAPSHOT_MAX_AGE:
+                self.log("[remotekubernetesplugin.load_snapshot] IGNORING OUTDATED SNAPSHOT %s", "info", path)
 
-                for metric in metrics:
-                    if metric['key'] == "kube_deployment_status_replicas_available":
-                        if int(metric['value']) == 1:
-                            custom_deployments_available['value'] = int(custom_deployments_available['value']) + 1
+                return
 
-                self.report_topology_metric(element, custom_deployments_available)
+            for cluster in self.args['clusters']:
+                state = snapshot['clusters'].get(cluster['id'])
+                if state is None or state['url'] != cluster['url']:
+                    continue
+
+                # Stage results keep the time they were collected at, so they
+                # are refreshed on their usual interval
+                for stage in state['stages']:
+                    cluster['stages'][stage]['result'] = state['stages'][stage]['result']
+                    cluster['stages'][stage]['time'] = state['stages'][stage]['time']
+
+                cluster['scrape_failures'] = dict((endpoint, tuple(failure)) for endpoint, failure in state['scrape_failures'].items())
 
-            if self.exists_metric(metrics, "kube_pod_container_status_ready"):
-                custom_deployments_unavailable = {'entity': 'CUSTOM_DEVICE', 'key': "custom_deployments_unavailable", 'type': "KubernetesStats", 'relative': False, 'dimensions': {}, 'value': 0}
+                # Watches resume from the stored resourceVersion, replaying only
+                # what changed since, or relist if it has been compacted away
+                for resource in state['inventory']:
+                    for path in state['inventory'][resource]:
+                        # Namespaces no longer included are left out
+                        inventory = cluster['inventory'][resource].get(path)
+                        stored = state['inventory'][resource][path]
+                        if inventory is None or stored['resource_version'] is None:
+                            continue
 
-                for metric in metrics:
-                    if metric['key'] == "kube_deployment_status_replicas_unavailable":
-                        if int(metric['value']) == 1:
-                            custom_deployments_unavailable['value'] = int(custom_deployments_unavailable['value']) + 1
+                        inventory['items'] = stored['items']
+                        inventory['resource_version'] = stored['resource_version']
+                        inventory['last_sync'] = stored['last_sync']
+                        inventory['synced'] = True
 
-                self.report_topology_metric(element, custom_deployments_unavailable)
+                self.log("[remotekubernetesplugin.load_snapshot] LOADED %s FROM %s", "info", cluster['id'], path)
+
+            return
         except Exception as exc:
-            self.log("[remotekubernetesplugin.report_topology_custom_element_metrics] EXCEPTION: " + str(exc), "info")
+            self.log("[remotekubernetesplugin.load_snapshot] EXCEPTION: %s", "info", exc)
 
             return
 
-    def report_topology_custom_group_metrics(self, group, metrics):
-        return
+    def write_snapshot(self):
+        try:
+            snapshot = {'version': SNAPSHOT_VERSION, 'time': time.time(), 'clusters': {}}
+
+            for cluster in self.args['clusters']:
+                stages = {}
+                for stage in cluster['stages']:
+                    stages[stage] = {'result': cluster['stages'][stage]['result'], 'time': cluster['stages'][stage]['time']}
+
+                inventories = {}
+                for resource in cluster['inventory']:
+                    inventories[resource] = {}
+                    for path, inventory in cluster['inventory'][resource].items():
+                        # The version is read before the items, so a watch event
+                        # in between is replayed on load instead of being lost
+                        resource_version = inventory['resource_version'] if inventory['synced'] else None
+                        with inventory['lock']:
+                            items = dict(inventory['items'])
+
+                        inventories[resource][path] = {'items': items, 'resource_version': resource_version,
+                                                       'last_sync': inventory['last_sync']}
+
+                snapshot['clusters'][cluster['id']] = {'url': cluster['url'], 'stages': stages, 'inventory': inventories,
+                                                       'scrape_failures': dict(cluster['scrape_failures'])}
+
+            # Written next to the target and renamed, so a crash while writing
+            # never leaves a truncated snapshot behind. JSON rather than pickle,
+            # so loading a tampered file cannot run code.
+            path = self.args['snapshot_file']
+            with open(path + ".tmp", "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            os.replace(path + ".tmp", path)
+
+            self.snapshot_time = time.time()
+
+            return
+        except Exception as exc:
+            self.log("[remotekubernetesplugin.write_snapshot] EXCEPTION: %s", "info", exc)
+
+            return
+
+    def log(self, msg, type, *args):
+        # Arguments are only formatted into msg once debug logging is known to
+        # be enabled, so disabled log calls never build strings
+        if self.debug:
+            if args:
+                msg = msg % args
 
-    def log(self, msg, type):
-        if self.args['debug'] == "true":
             if type == "info":
                 logger.info(msg)
             if type == "error":
@@ -651,6 +2710,33 @@ class RemoteKubernetesPlugin(RemoteBasePlugin):
 
         return
 
+    def log_sampled(self, msg, type, *args):
+        # Per-object and per-sample messages: only the first LOG_SAMPLE_LIMIT
+        # occurrences of each message are written per poll, the rest counted
+        if self.debug:
+            with self.log_samples_lock:
+                count = self.log_samples.get(msg, 0) + 1
+                self.log_samples[msg] = count
+
+            if count <= LOG_SAMPLE_LIMIT:
+                self.log(msg, type, *args)
+
+        return
+
+    def flush_log_samples(self):
+        # Workers still running past the deadline keep counting, into the
+        # dict of the next poll once this one has been swapped out
+        with self.log_samples_lock:
+            log_samples = self.log_samples
+            self.log_samples = {}
+
+        if self.debug:
+            for msg, count in log_samples.items():
+                if count > LOG_SAMPLE_LIMIT:
+                    self.log("[remotekubernetesplugin.log_sampled] SUPPRESSED %s x %s", "info", count - LOG_SAMPLE_LIMIT, msg)
+
+        return
+
 
 #class Test:
 #    @staticmethod